@@ -0,0 +1,70 @@
+# benchmarks/bench_cold_start.py
+"""Время холодного старта main.py (импорты, роутеры, инициализация БД) с бюджетом.
+
+Запуск: python benchmarks/bench_cold_start.py --runs 5 --budget 10
+Код выхода 1, если медиана превышает бюджет (для CI).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = (
+    "import json, main\n"
+    "from core.profiling import startup_profiler\n"
+    "print(json.dumps(startup_profiler.report()))\n"
+)
+
+
+def run_once(cwd: str) -> tuple:
+    """Один запуск в чистом процессе: (время процесса, отчёт профайлера)."""
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": ROOT,
+        "STARTUP_PROFILE": "1",
+        "BOT_TOKEN": env.get("BOT_TOKEN", "123456:BENCHMARK"),
+    })
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD], cwd=cwd, env=env,
+        capture_output=True, text=True, check=True
+    )
+    elapsed = time.perf_counter() - started
+    return elapsed, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=float(os.getenv("COLD_START_BUDGET", 10.0)))
+    args = parser.parse_args()
+
+    timings = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(args.runs):
+            elapsed, report = run_once(tmp)
+            timings.append(elapsed)
+
+    median = statistics.median(timings)
+    print(json.dumps({
+        "runs": args.runs,
+        "median": round(median, 4),
+        "max": round(max(timings), 4),
+        "budget": args.budget,
+        "last_report": report
+    }, ensure_ascii=False, indent=2))
+
+    if median > args.budget:
+        print(f"❌ Холодный старт {median:.3f} с превышает бюджет {args.budget:.3f} с")
+        sys.exit(1)
+    print(f"✅ Холодный старт {median:.3f} с в пределах бюджета {args.budget:.3f} с")
+
+
+if __name__ == "__main__":
+    main()
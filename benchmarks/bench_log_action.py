@@ -0,0 +1,50 @@
+# benchmarks/bench_log_action.py
+"""Сравнение пропускной способности записи user_actions.
+
+Запуск: python benchmarks/bench_log_action.py --rows 20000
+
+* per-commit — каждое действие отдельной транзакцией (как было раньше);
+* buffered   — DatabaseManager.log_action + flush(): executemany одной транзакцией.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.db_manager import DatabaseManager, SQL_INSERT_ACTION
+
+
+async def bench_per_commit(manager: DatabaseManager, rows: int) -> float:
+    started = time.perf_counter()
+    for i in range(rows):
+        await manager._write([(SQL_INSERT_ACTION, (i % 1000, "click", "content", ""))])
+    return time.perf_counter() - started
+
+
+async def bench_buffered(manager: DatabaseManager, rows: int) -> float:
+    started = time.perf_counter()
+    for i in range(rows):
+        await manager.log_action(i % 1000, "click", "content", "")
+    await manager.flush()
+    return time.perf_counter() - started
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, bench in (("per-commit", bench_per_commit), ("buffered", bench_buffered)):
+            manager = DatabaseManager(os.path.join(tmp, f"{name}.db"))
+            elapsed = await bench(manager, args.rows)
+            manager.close()
+            print(f"{name:>10}: {args.rows} строк за {elapsed:.3f} с ({args.rows / elapsed:,.0f} строк/с)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+# benchmarks/bench_user_stats.py
+"""Латентность агрегата статистики по user_actions до и после индексов (миграция схемы v2).
+
+Запуск: python benchmarks/bench_user_stats.py --rows 1000000 10000000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.db_manager import connect, apply_migrations, SQL_INSERT_ACTION
+
+# Запрос по сырым строкам, которым get_user_stats считал статистику до счётчиков (v3)
+SQL_RAW_STATS = "SELECT bot_mode, COUNT(*) as count FROM user_actions WHERE user_id = ? GROUP BY bot_mode"
+
+MODES = ("subscription", "info", "content")
+USERS = 50000
+CHUNK = 100000
+
+
+def fill(conn, rows: int):
+    """Заполняет user_actions пачками по CHUNK строк."""
+    rnd = random.Random(42)
+    for offset in range(0, rows, CHUNK):
+        conn.execute("BEGIN")
+        conn.executemany(SQL_INSERT_ACTION, (
+            (rnd.randrange(USERS), "click", rnd.choice(MODES), "")
+            for _ in range(min(CHUNK, rows - offset))
+        ))
+        conn.execute("COMMIT")
+
+
+def measure(conn, queries: int) -> float:
+    """Средняя латентность запроса статистики, мс."""
+    rnd = random.Random(7)
+    started = time.perf_counter()
+    for _ in range(queries):
+        conn.execute(SQL_RAW_STATS, (rnd.randrange(USERS),)).fetchall()
+    return (time.perf_counter() - started) / queries * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000000])
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.rows:
+            conn = connect(os.path.join(tmp, f"actions_{rows}.db"))
+            apply_migrations(conn, target=1)
+            fill(conn, rows)
+
+            before = measure(conn, args.queries)
+            apply_migrations(conn, target=2)
+            after = measure(conn, args.queries)
+            conn.close()
+
+            print(f"{rows:>11,} строк: без индекса {before:8.3f} мс, с индексом {after:8.3f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,19 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+import os
+import time
+import random
+import asyncio
 import logging
-import aiohttp
 import json
 
+from core.http_client import http_client
+from core.generation_cache import generation_cache, normalize_topic, make_key
+from core.ratelimit import TokenBucket, SingleFlight
+from core.metrics import OPENAI_REQUEST_DURATION, OPENAI_REQUESTS
+from core.tracing import traced
+
 router = Router()
 logger = logging.getLogger(__name__)
 
@@ -19,6 +28,28 @@ try:
 except ImportError:
     HAS_OPENAI = False
 
+OPENAI_MODEL = "gpt-3.5-turbo"
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
+
+# Потоковая генерация: текст показывается по мере поступления токенов
+OPENAI_STREAM = os.getenv("OPENAI_STREAM", "1") == "1"
+# Не чаще одного редактирования сообщения за интервал (лимиты Telegram ~1 правка/с на чат)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+# Лимит длины сообщения Telegram — 4096 символов, промежуточный текст обрезаем с запасом
+STREAM_PREVIEW_LIMIT = 3900
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Ограничения на запросы к OpenAI: параллельность, частота, повторы при 429
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 8))
+OPENAI_RATE_PER_SEC = float(os.getenv("OPENAI_RATE_PER_SEC", 3))
+OPENAI_BURST = float(os.getenv("OPENAI_BURST", 10))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 3))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", 1.0))
+
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+openai_bucket = TokenBucket(OPENAI_RATE_PER_SEC, OPENAI_BURST)
+openai_flights = SingleFlight()
+
 
 # Состояния для FSM
 class ContentGen(StatesGroup):
@@ -55,45 +86,172 @@ def get_platform_keyboard():
         [InlineKeyboardButton(text="🌐 ВКонтакте", callback_data="platform_vk"),
          InlineKeyboardButton(text="🐦 Twitter", callback_data="platform_twitter")],
         [InlineKeyboardButton(text="📝 Блог", callback_data="platform_blog")],
+        [InlineKeyboardButton(text="🌐 Все платформы", callback_data="platform_all")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="cancel")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-async def generate_with_openai(prompt: str) -> str:
-    """Генерация текста через OpenAI API"""
+async def parse_sse_stream(lines):
+    """Разбирает SSE-поток chat completions и отдаёт фрагменты текста.
+
+    lines — асинхронный итератор строк (bytes), например response.content.
+    """
+    async for raw_line in lines:
+        line = raw_line.decode("utf-8").strip()
+        if not line.startswith("data:"):
+            continue
+        payload = line[len("data:"):].strip()
+        if payload == "[DONE]":
+            break
+        chunk = json.loads(payload)
+        for choice in chunk.get("choices", []):
+            delta = choice.get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+
+class OpenAIRateLimited(Exception):
+    """OpenAI ответил 429; retry_after — сколько секунд просит подождать (или None)."""
+
+    def __init__(self, retry_after: float = None):
+        super().__init__(f"OpenAI rate limited, retry after {retry_after}")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(headers) -> float:
+    """Достаёт задержку из Retry-After / retry-after-ms."""
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("Retry-After"):
+            return float(headers["Retry-After"])
+    except ValueError:
+        pass
+    return None
+
+
+@traced("openai")
+async def generate_with_openai(prompt: str, on_progress=None) -> str:
+    """Генерация текста через OpenAI API
+
+    Если передан on_progress, ответ читается потоком и корутина
+    on_progress(text) вызывается с накопленным текстом после каждого фрагмента.
+    Одновременные запросы с одинаковым промптом объединяются в один.
+    """
     if not HAS_OPENAI:
         return None
 
     try:
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json"
-            }
-            data = {
-                "model": "gpt-3.5-turbo",
-                "messages": [{"role": "user", "content": prompt}],
-                "max_tokens": 1000,
-                "temperature": 0.7
-            }
-
-            async with session.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers=headers,
-                    json=data
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result["choices"][0]["message"]["content"]
-                else:
-                    logger.error(f"OpenAI API error: {response.status}")
-                    return None
+        return await openai_flights.do(prompt, lambda: _request_with_retry(prompt, on_progress))
     except Exception as e:
         logger.error(f"Error generating content: {e}")
         return None
 
 
+async def _request_with_retry(prompt: str, on_progress=None) -> str:
+    """Запрос с ограничением параллельности и частоты; 429 повторяется с джиттером."""
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        try:
+            async with openai_semaphore:
+                await openai_bucket.acquire()
+                return await _request_openai(prompt, on_progress)
+        except OpenAIRateLimited as e:
+            if attempt == OPENAI_MAX_RETRIES:
+                raise
+            # Не раньше, чем просит сервер; джиттер разводит повторы разных запросов
+            delay = max(e.retry_after or 0, OPENAI_RETRY_BASE_DELAY * 2 ** attempt)
+            delay *= random.uniform(1.0, 1.5)
+            logger.warning(f"OpenAI 429, повтор {attempt + 1}/{OPENAI_MAX_RETRIES} через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+
+async def _request_openai(prompt: str, on_progress=None) -> str:
+    """Один HTTP-запрос к OpenAI."""
+    stream = on_progress is not None and OPENAI_STREAM
+
+    headers = {
+        "Authorization": f"Bearer {OPENAI_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    data = {
+        "model": OPENAI_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": 1000,
+        "temperature": 0.7,
+        "stream": stream
+    }
+
+    started = time.perf_counter()
+    status = "error"
+    try:
+        # Общая сессия приложения: соединение с api.openai.com переиспользуется
+        async with http_client.session.post(
+                OPENAI_API_URL,
+                headers=headers,
+                json=data
+        ) as response:
+            status = str(response.status)
+            if response.status == 429:
+                raise OpenAIRateLimited(parse_retry_after(response.headers))
+            if response.status != 200:
+                logger.error(f"OpenAI API error: {response.status}")
+                return None
+
+            if not stream:
+                result = await response.json()
+                return result["choices"][0]["message"]["content"]
+
+            parts = []
+            async for delta in parse_sse_stream(response.content):
+                parts.append(delta)
+                await on_progress("".join(parts))
+            return "".join(parts) or None
+    finally:
+        OPENAI_REQUEST_DURATION.observe(time.perf_counter() - started, status=status)
+        OPENAI_REQUESTS.inc(status=status)
+
+
+class ProgressiveEditor:
+    """Показывает текст по мере генерации, редактируя сообщение не чаще интервала."""
+
+    def __init__(self, message, interval: float = STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._last_edit = 0.0
+        self._last_text = ""
+
+    async def __call__(self, text: str):
+        now = time.monotonic()
+        if now - self._last_edit < self.interval or text == self._last_text:
+            return
+        self._last_edit = now
+        self._last_text = text
+
+        preview = text if len(text) <= STREAM_PREVIEW_LIMIT else "…" + text[-STREAM_PREVIEW_LIMIT:]
+        try:
+            await self.message.edit_text(f"{preview} ▌")
+        except Exception as e:
+            # Промежуточные правки необязательны: итоговое сообщение всё равно будет показано
+            logger.debug(f"Пропущено промежуточное редактирование: {e}")
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """Делит длинный текст на части не длиннее limit, по возможности по границам абзацев и строк."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+
 def generate_fake_content(prompt: str) -> str:
     """Заглушка для генерации контента (если нет OpenAI API)"""
     # Примеры сгенерированного контента
@@ -174,49 +332,69 @@ async def process_topic(message: Message, state: FSMContext):
     await state.set_state(ContentGen.waiting_for_platform)
 
 
-@router.callback_query(F.data.startswith("platform_"))
-async def process_platform(callback: CallbackQuery, state: FSMContext):
-    """Обработка выбора платформы"""
-    platform = callback.data.replace("platform_", "")
-    platform_names = {
-        "telegram": "Telegram",
-        "instagram": "Instagram",
-        "vk": "ВКонтакте",
-        "twitter": "Twitter",
-        "blog": "Блог"
-    }
+PLATFORM_NAMES = {
+    "telegram": "Telegram",
+    "instagram": "Instagram",
+    "vk": "ВКонтакте",
+    "twitter": "Twitter",
+    "blog": "Блог"
+}
 
-    await state.update_data(platform=platform)
-    data = await state.get_data()
 
-    # Генерируем контент
-    await callback.message.edit_text("🔄 Генерирую контент...")
+async def generate_post_content(platform: str, topic: str, regenerate: bool = False,
+                                on_progress=None) -> str:
+    """Генерация поста с кэшем по (платформа, модель, промпт с нормализованной темой)"""
+    template = PLATFORM_PROMPTS.get(platform, PLATFORM_PROMPTS["telegram"])
+
+    # Без OpenAI используем заглушку
+    if not HAS_OPENAI:
+        return generate_fake_content(platform)
 
-    prompt = PLATFORM_PROMPTS.get(platform, PLATFORM_PROMPTS["telegram"]).format(topic=data["topic"])
+    # В OpenAI уходит тема как есть, нормализованная — только для ключа кэша
+    prompt = template.format(topic=topic)
+    cache_key = make_key(platform, OPENAI_MODEL, template.format(topic=normalize_topic(topic)))
 
-    # Пытаемся использовать OpenAI, если есть ключ
-    if HAS_OPENAI:
-        content = await generate_with_openai(prompt)
-    else:
-        content = generate_fake_content(platform)
+    # «🔄 Новый пост» пропускает кэш и перезаписывает запись
+    if not regenerate:
+        content = await generation_cache.get(cache_key)
+        if content:
+            return content
 
+    content = await generate_with_openai(prompt, on_progress=on_progress)
     if content:
-        # Сохраняем результат
-        await state.update_data(content=content)
+        await generation_cache.set(cache_key, content)
+    return content
 
-        # Показываем результат
+
+def get_result_keyboard() -> InlineKeyboardMarkup:
+    """Клавиатура под готовым постом"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Новый пост", callback_data="regenerate_post")],
+        [InlineKeyboardButton(text="📝 Другая тема", callback_data="generate_post")],
+        [InlineKeyboardButton(text="💾 Сохранить", callback_data="save_content")],
+        [InlineKeyboardButton(text="📋 В главное меню", callback_data="main_menu")]
+    ])
+
+
+async def show_generated_post(callback: CallbackQuery, state: FSMContext, platform: str, topic: str,
+                              regenerate: bool = False):
+    """Генерирует пост и показывает результат"""
+    await callback.message.edit_text("🔄 Генерирую контент...")
+
+    content = await generate_post_content(
+        platform, topic, regenerate=regenerate, on_progress=ProgressiveEditor(callback.message)
+    )
+
+    if content:
+        # Показываем результат (итоговая правка — с клавиатурой)
         await callback.message.edit_text(
             f"✅ **Готово!**\n\n"
-            f"**Платформа:** {platform_names.get(platform, platform)}\n"
-            f"**Тема:** {data['topic']}\n\n"
+            f"**Платформа:** {PLATFORM_NAMES.get(platform, platform)}\n"
+            f"**Тема:** {topic}\n\n"
             f"**Ваш пост:**\n\n{content}\n\n"
             f"---\n"
             f"Что дальше?",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔄 Новый пост", callback_data="generate_post")],
-                [InlineKeyboardButton(text="💾 Сохранить", callback_data="save_content")],
-                [InlineKeyboardButton(text="📋 В главное меню", callback_data="main_menu")]
-            ])
+            reply_markup=get_result_keyboard()
         )
     else:
         await callback.message.edit_text(
@@ -226,7 +404,95 @@ async def process_platform(callback: CallbackQuery, state: FSMContext):
             ])
         )
 
-    await state.clear()
+    # Диалог завершён, но тема и платформа остаются в данных для «🔄 Новый пост»
+    await state.set_state(None)
+    await state.set_data({"topic": topic, "platform": platform, "content": content})
+
+
+async def show_all_platforms(callback: CallbackQuery, state: FSMContext, topic: str,
+                             regenerate: bool = False):
+    """Генерирует посты для всех платформ параллельно и присылает каждый по готовности"""
+    await callback.message.edit_text(f"🔄 Генерирую посты для {len(PLATFORM_PROMPTS)} платформ...")
+
+    async def generate(platform: str):
+        started = time.perf_counter()
+        content = await generate_post_content(platform, topic, regenerate=regenerate)
+        return platform, content, time.perf_counter() - started
+
+    # Общий лимит параллельности OpenAI соблюдается внутри generate_with_openai
+    tasks = [asyncio.create_task(generate(platform)) for platform in PLATFORM_PROMPTS]
+    latencies = {}
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            # Ошибка одной платформы (генерация или отправка) не мешает остальным
+            try:
+                platform, content, latency = await next_done
+                latencies[platform] = latency
+                logger.info(f"Пост для {platform} сгенерирован за {latency:.1f} с")
+
+                name = PLATFORM_NAMES.get(platform, platform)
+                if content:
+                    for part in split_message(f"✅ **{name}** ({latency:.1f} с)\n\n{content}"):
+                        await callback.message.answer(part)
+                else:
+                    await callback.message.answer(f"😕 **{name}**: не удалось сгенерировать контент.")
+            except Exception as e:
+                logger.error(f"❌ Ошибка поста для одной из платформ: {e}")
+
+        report = "\n".join(
+            f"• {PLATFORM_NAMES.get(platform, platform)}: {latency:.1f} с"
+            for platform, latency in latencies.items()
+        ) or "—"
+        await callback.message.answer(
+            f"✅ **Готово!**\n\n"
+            f"**Тема:** {topic}\n\n"
+            f"**Время генерации:**\n{report}\n\n"
+            f"Что дальше?",
+            reply_markup=get_result_keyboard()
+        )
+        await callback.message.delete()
+    finally:
+        # Незавершённые генерации не работают в фоне: запрос к OpenAI отменяется,
+        # если его результата не ждёт другой пользователь (см. SingleFlight)
+        for task in tasks:
+            task.cancel()
+        await state.set_state(None)
+        await state.set_data({"topic": topic, "platform": "all"})
+
+
+@router.callback_query(F.data == "platform_all")
+async def process_all_platforms(callback: CallbackQuery, state: FSMContext):
+    """Обработка выбора «Все платформы»"""
+    data = await state.get_data()
+
+    await callback.answer()
+    await show_all_platforms(callback, state, data["topic"])
+
+
+@router.callback_query(F.data.startswith("platform_"))
+async def process_platform(callback: CallbackQuery, state: FSMContext):
+    """Обработка выбора платформы"""
+    platform = callback.data.replace("platform_", "")
+    data = await state.get_data()
+
+    await show_generated_post(callback, state, platform, data["topic"])
+    await callback.answer()
+
+
+@router.callback_query(F.data == "regenerate_post")
+async def regenerate_post(callback: CallbackQuery, state: FSMContext):
+    """Новый вариант поста на ту же тему (в обход кэша)"""
+    data = await state.get_data()
+    if not data.get("topic") or not data.get("platform"):
+        await start_generation(callback, state)
+        return
+
+    if data["platform"] == "all":
+        await callback.answer()
+        await show_all_platforms(callback, state, data["topic"], regenerate=True)
+        return
+
+    await show_generated_post(callback, state, data["platform"], data["topic"], regenerate=True)
     await callback.answer()
 
 
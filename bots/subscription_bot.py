@@ -62,11 +62,11 @@ async def trial_handler(callback: CallbackQuery):
         bot_mode="subscription",
         details="Запрошен пробный период"
     )
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
 
     if not user:
-        db.create_user(user_id, callback.from_user.username)
-        user = db.get_user(user_id)
+        await db.create_user(user_id, callback.from_user.username)
+        user = await db.get_user(user_id)
 
     if user["trial_used"]:
         await callback.message.edit_text(
@@ -75,7 +75,7 @@ async def trial_handler(callback: CallbackQuery):
             reply_markup=get_back_to_menu()
         )
     else:
-        db.set_trial_used(user_id, days=3)
+        await db.set_trial_used(user_id, days=3)
         await callback.message.edit_text(
             "✅ Вам выдан пробный период на 3 дня!\n\n"
             "Теперь у вас есть доступ ко всем функциям сервиса.\n"
@@ -106,8 +106,8 @@ async def confirm_payment_handler(callback: CallbackQuery):
 
     # В реальном боте здесь будет интеграция с платежной системой
     # Для демо просто активируем подписку
-    db.set_paid_subscription(user_id, days=30)
-    db.add_payment(user_id, 500, "Подписка на 1 месяц")
+    await db.set_paid_subscription(user_id, days=30)
+    await db.add_payment(user_id, 500, "Подписка на 1 месяц")
 
     await callback.message.edit_text(
         "✅ **Оплата прошла успешно!**\n\n"
@@ -122,7 +122,7 @@ async def confirm_payment_handler(callback: CallbackQuery):
 async def my_access_handler(callback: CallbackQuery):
     """Проверка статуса доступа"""
     user_id = callback.from_user.id
-    status = db.get_user_status(user_id)
+    status = await db.get_user_status(user_id)
 
     if status["active"]:
         if status["type"] == "trial":
@@ -1,12 +1,17 @@
 import os
 import json
+import time
 import base64
+import sqlite3
+import asyncio
 import logging
+import threading
 from datetime import datetime
 
-import gspread
-from google.oauth2.service_account import Credentials
+from core.metrics import SHEETS_FLUSH_DURATION
+from core.tracing import traced
 
+# gspread и google-auth импортируются лениво в _connect: это заметная часть холодного старта
 logger = logging.getLogger(__name__)
 
 SCOPES = [
@@ -16,17 +21,112 @@ SCOPES = [
 DEFAULT_SPREADSHEET_ID = "1acJjGdELWRm9urc1q2dDy5OymQ2fN2K-q9njTHpcO-Q"
 WORKSHEET_NAME = "Лог событий"
 
+# Параметры фоновой отправки событий
+QUEUE_MAXSIZE = int(os.getenv("ANALYTICS_QUEUE_MAXSIZE", 10000))
+BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", 50))
+FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", 2.0))
+
+# Локальный спул для событий, которые не удалось записать в таблицу
+SPOOL_PATH = os.getenv("ANALYTICS_SPOOL_PATH", "analytics_spool.db")
+REPLAY_BATCH_SIZE = int(os.getenv("ANALYTICS_REPLAY_BATCH_SIZE", 500))
+RETRY_MIN_DELAY = float(os.getenv("ANALYTICS_RETRY_MIN_DELAY", 5))
+RETRY_MAX_DELAY = float(os.getenv("ANALYTICS_RETRY_MAX_DELAY", 300))
+# Предел спула: сверх него события отбрасываются, чтобы долгий простой Google не съел диск
+SPOOL_MAX_EVENTS = int(os.getenv("ANALYTICS_SPOOL_MAX_EVENTS", 100000))
+
+
+class EventSpool:
+    """Append-only спул событий в SQLite: переживает рестарт и недоступность Google."""
+
+    def __init__(self, path: str = SPOOL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, row TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def append(self, rows: list):
+        """Дописывает строки в конец спула."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO events (row) VALUES (?)",
+                [(json.dumps(row, ensure_ascii=False),) for row in rows]
+            )
+
+    def read(self, limit: int) -> list:
+        """Возвращает самые старые записи: [(id, row), ...]."""
+        with self._lock:
+            cursor = self._conn.execute("SELECT id, row FROM events ORDER BY id LIMIT ?", (limit,))
+            return [(row_id, json.loads(row)) for row_id, row in cursor.fetchall()]
+
+    def delete_up_to(self, last_id: int):
+        """Удаляет отправленные записи."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM events WHERE id <= ?", (last_id,))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
 
 class GoogleSheetsAnalytics:
     def __init__(self):
         self.sheet = None
         self.spreadsheet_id = None
-        self._init_connection()
+
+        # Очередь событий: log_event только кладёт строку, запись делает фоновая задача
+        self._queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._worker = None
+        # Переполнение очереди: строки ждут в памяти, в спул их пишет фоновая задача
+        self._overflow = []
+
+        # Спул и экспоненциальная задержка переподключения/повтора
+        self._spool = EventSpool()
+        self.spooled_events = self._spool.count()
+        self._retry_delay = RETRY_MIN_DELAY
+        self._next_retry_at = 0.0
+
+        # Метрики
+        self.dropped_events = 0
+        self.flushed_events = 0
+        self.flush_count = 0
+        self.last_flush_latency = None
+
+        # Подключение выполняется лениво в фоне (см. start), а не при импорте
+        self._connecting = None
+        # Credentials не настроены: события не пишутся и не копятся, переподключения нет
+        self.disabled = False
+
+    @property
+    def ready(self) -> bool:
+        """Первая попытка подключения завершена."""
+        return self._connecting is not None and self._connecting.done()
 
     def _init_connection(self):
-        """Инициализация подключения с детальными отпечатками."""
+        """Инициализация подключения с замером времени по фазам."""
+        timings = {}
+        started = time.perf_counter()
+        try:
+            self._connect(timings)
+        finally:
+            breakdown = ", ".join(f"{name}={seconds:.3f}с" for name, seconds in timings.items())
+            logger.info(f"⏱ _init_connection: {time.perf_counter() - started:.3f} с ({breakdown})")
+
+    def _connect(self, timings: dict):
+        """Подключение с детальными отпечатками."""
         print("🔥🔥🔥 _init_connection ВЫЗВАН 🔥🔥🔥", flush=True)
         logger.info("🚦 НАЧАЛО _init_connection")
+        phase = time.perf_counter()
+        import gspread
+        from google.oauth2.service_account import Credentials
+        timings["import"] = time.perf_counter() - phase
+        phase = time.perf_counter()
         creds_json = None
 
         # ----- 1. Пробуем base64 -----
@@ -65,11 +165,13 @@ class GoogleSheetsAnalytics:
             else:
                 logger.warning("❌ Шаг 3: файл не найден, аналитика отключена")
                 self.sheet = None
+                self.disabled = True
                 return
 
         if not creds_json:
-            logger.error("❌ Шаг: нет credentials, останов")
+            logger.error("❌ Шаг: нет credentials, аналитика отключена")
             self.sheet = None
+            self.disabled = True
             return
 
         # ----- 4. Парсинг JSON -----
@@ -81,6 +183,8 @@ class GoogleSheetsAnalytics:
             logger.error(f"❌ Шаг 4.1: ошибка парсинга JSON: {e}")
             self.sheet = None
             return
+        timings["credentials"] = time.perf_counter() - phase
+        phase = time.perf_counter()
 
         # ----- 5. Авторизация -----
         logger.info("🔍 Шаг 5: авторизация в Google")
@@ -92,6 +196,8 @@ class GoogleSheetsAnalytics:
             logger.error(f"❌ Шаг 5.1: ошибка авторизации: {e}")
             self.sheet = None
             return
+        timings["auth"] = time.perf_counter() - phase
+        phase = time.perf_counter()
 
         # ----- 6. ID таблицы -----
         logger.info("🔍 Шаг 6: получение ID таблицы")
@@ -111,6 +217,8 @@ class GoogleSheetsAnalytics:
             logger.error(f"❌ Шаг 7.1: ошибка открытия таблицы: {e}")
             self.sheet = None
             return
+        timings["open_by_key"] = time.perf_counter() - phase
+        phase = time.perf_counter()
 
         # ----- 8. Получение/создание листа -----
         logger.info(f"🔍 Шаг 8: получение листа {WORKSHEET_NAME}")
@@ -122,10 +230,13 @@ class GoogleSheetsAnalytics:
             self.sheet = spreadsheet.add_worksheet(title=WORKSHEET_NAME, rows=1000, cols=20)
             self._ensure_headers()
             logger.info("✅ Шаг 8.3: новый лист создан")
+        timings["worksheet"] = time.perf_counter() - phase
+        phase = time.perf_counter()
 
         # ----- 9. Проверка/создание заголовков -----
         self._ensure_headers()
         logger.info("✅ Шаг 9: заголовки проверены/созданы")
+        timings["headers"] = time.perf_counter() - phase
 
         # ----- 10. УСПЕХ -----
         logger.info("🎉🎉🎉 ПОДКЛЮЧЕНИЕ К GOOGLE SHEETS УСТАНОВЛЕНО 🎉🎉🎉")
@@ -146,52 +257,208 @@ class GoogleSheetsAnalytics:
             logger.error(f"❌ Ошибка заголовков: {e}")
 
     def ensure_connection(self):
-        """Если соединение потеряно, пробуем переподключиться."""
-        if not self.sheet:
+        """Если соединение потеряно, пробуем переподключиться (не чаще, чем позволяет backoff)."""
+        if self.disabled:
+            return False
+        if not self.sheet and time.monotonic() >= self._next_retry_at:
             logger.warning("⚠️ Соединение потеряно, пробую переподключиться...")
             self._init_connection()
+            if not self.sheet:
+                self._schedule_retry()
         return self.sheet is not None
 
+    def _schedule_retry(self):
+        """Откладывает следующую попытку с экспоненциальным ростом задержки."""
+        self._next_retry_at = time.monotonic() + self._retry_delay
+        logger.warning(f"⏳ Следующая попытка записи в Google Sheets через {self._retry_delay:.0f} с")
+        self._retry_delay = min(self._retry_delay * 2, RETRY_MAX_DELAY)
+
+    @traced("analytics")
     def log_event(self, user_id: int, username: str = "", action: str = "",
                   bot_mode: str = "", details: str = "", source: str = "telegram_bot") -> bool:
-        """Запись события в Google Sheets."""
+        """Ставит событие в очередь на запись в Google Sheets (не блокирует хендлер)."""
         # 🔍 ДИАГНОСТИКА
         logger.info(f"🟡 log_event ВЫЗВАН: action={action}, user={user_id}, bot_mode={bot_mode}")
-        logger.info(f"🟡 Состояние self.sheet: {self.sheet is not None}")
+        if self.disabled:
+            return False
 
-        # Если sheet нет, пытаемся переподключиться
-        if not self.sheet:
-            self.ensure_connection()
-            if not self.sheet:
-                logger.info(f"[ANALYTICS] {user_id} | {action} | {bot_mode} | {details}")
-                return False
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        username_clean = username or ""
+        session_id = f"{datetime.now().strftime('%Y%m%d')}_{user_id}"
+
+        row = [
+            timestamp,
+            str(user_id),
+            username_clean,
+            action,
+            bot_mode,
+            details,
+            source,
+            session_id
+        ]
 
         try:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            username_clean = username or ""
-            session_id = f"{datetime.now().strftime('%Y%m%d')}_{user_id}"
-
-            row = [
-                timestamp,
-                str(user_id),
-                username_clean,
-                action,
-                bot_mode,
-                details,
-                source,
-                session_id
-            ]
-
-            # 🟢 Пробуем записать
-            self.sheet.append_row(row, value_input_option="USER_ENTERED")
-            logger.info(f"✅✅✅ ЗАПИСАНО В GOOGLE SHEETS: {row}")
-            return True
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            # Очередь переполнена — откладываем событие для спула; SQLite в хендлере не трогаем
+            if self.spooled_events + len(self._overflow) >= SPOOL_MAX_EVENTS:
+                self.dropped_events += 1
+                logger.error(f"❌ Событие аналитики потеряно, спул заполнен ({SPOOL_MAX_EVENTS}): {row}")
+            else:
+                self._overflow.append(row)
+                self._batch_ready.set()
+            return False
+
+        if self._queue.qsize() >= BATCH_SIZE:
+            self._batch_ready.set()
+        return True
+
+    @property
+    def queue_depth(self) -> int:
+        """Количество событий, ожидающих записи."""
+        return self._queue.qsize()
+
+    def get_stats(self) -> dict:
+        """Метрики очереди и записи в таблицу."""
+        return {
+            "queue_depth": self.queue_depth,
+            "dropped_events": self.dropped_events,
+            "flushed_events": self.flushed_events,
+            "flush_count": self.flush_count,
+            "spooled_events": self.spooled_events,
+            "overflow_events": len(self._overflow),
+            "last_flush_latency": self.last_flush_latency
+        }
 
+    async def start(self):
+        """Запускает подключение к Google Sheets и фоновую запись, не дожидаясь их.
+
+        До завершения подключения события копятся в очереди.
+        """
+        if self._connecting is None:
+            self._connecting = asyncio.create_task(asyncio.to_thread(self._init_connection))
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+            logger.info("🔄 Фоновая запись аналитики запущена")
+
+    async def stop(self):
+        """Останавливает фоновую задачу и дописывает остаток очереди."""
+        if self._connecting is not None and not self._connecting.done():
+            # Подключение ещё идёт — остаток очереди уйдёт в спул
+            self._connecting.cancel()
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        await self.flush()
+        logger.info("✅ Очередь аналитики сброшена")
+
+    async def _run(self):
+        """Сбрасывает очередь по размеру пачки или по таймеру."""
+        # Ждём первую попытку подключения, чтобы не писать в спул то, что можно отправить сразу
+        try:
+            await self._connecting
         except Exception as e:
+            logger.error(f"❌ Ошибка подключения к Google Sheets: {e}")
+
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            try:
+                await self.flush()
+                await self.replay()
+            except Exception as e:
+                logger.error(f"❌ Ошибка фоновой записи аналитики: {e}")
+
+    async def flush(self):
+        """Записывает все накопленные события пачками (один append_rows на пачку)."""
+        async with self._flush_lock:
+            while not self._queue.empty():
+                batch = []
+                while len(batch) < BATCH_SIZE and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                await self._write_batch(batch)
+            if self._overflow:
+                rows, self._overflow = self._overflow, []
+                await self._spool_rows(rows)
+
+    async def replay(self):
+        """Дозаписывает события из спула, когда Google Sheets снова доступна."""
+        if self.disabled or not self.spooled_events or time.monotonic() < self._next_retry_at:
+            return
+
+        async with self._flush_lock:
+            if not await asyncio.to_thread(self.ensure_connection):
+                return
+
+            while True:
+                items = await asyncio.to_thread(self._spool.read, REPLAY_BATCH_SIZE)
+                if not items:
+                    self.spooled_events = 0
+                    break
+                if not await self._append_rows([row for _, row in items]):
+                    self._schedule_retry()
+                    return
+                await asyncio.to_thread(self._spool.delete_up_to, items[-1][0])
+                self.spooled_events = max(self.spooled_events - len(items), 0)
+                logger.info(f"✅ Из спула дозаписано {len(items)} событий")
+
+        self._retry_delay = RETRY_MIN_DELAY
+
+    async def _write_batch(self, rows: list) -> bool:
+        """Одна пачка — один запрос к Google Sheets; при неудаче пачка уходит в спул."""
+        if self.disabled:
+            logger.info(f"[ANALYTICS] аналитика отключена, {len(rows)} событий отброшено")
+            return False
+
+        # Пока спул не пуст или нет соединения, пишем в спул, чтобы сохранить порядок событий
+        if self.spooled_events or not self.sheet:
+            await self._spool_rows(rows)
+            return False
+
+        if not await self._append_rows(rows):
+            self._schedule_retry()
+            await self._spool_rows(rows)
+            return False
+        return True
+
+    async def _append_rows(self, rows: list) -> bool:
+        """Запись пачки строк в отдельном потоке с замером задержки."""
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self.sheet.append_rows, rows, value_input_option="USER_ENTERED")
+        except Exception as e:
+            SHEETS_FLUSH_DURATION.observe(time.perf_counter() - started, result="error")
             logger.error(f"❌❌❌ ОШИБКА ЗАПИСИ В GOOGLE SHEETS: {e}")
             # Не обнуляем self.sheet — возможно, ошибка временная
             return False
 
+        self.last_flush_latency = time.perf_counter() - started
+        SHEETS_FLUSH_DURATION.observe(self.last_flush_latency, result="ok")
+        self.flush_count += 1
+        self.flushed_events += len(rows)
+        logger.info(f"✅✅✅ ЗАПИСАНО В GOOGLE SHEETS: {len(rows)} строк за {self.last_flush_latency:.3f} с")
+        return True
+
+    async def _spool_rows(self, rows: list):
+        free = SPOOL_MAX_EVENTS - self.spooled_events
+        if len(rows) > free:
+            dropped = len(rows) - max(free, 0)
+            self.dropped_events += dropped
+            logger.error(f"❌ Спул аналитики заполнен ({SPOOL_MAX_EVENTS}), отброшено {dropped} событий")
+            rows = rows[:max(free, 0)]
+            if not rows:
+                return
+        await asyncio.to_thread(self._spool.append, rows)
+        self.spooled_events += len(rows)
+        logger.info(f"[ANALYTICS] {len(rows)} событий отложено в спул (всего {self.spooled_events})")
+
     def test_connection(self) -> bool:
         """Проверка соединения (быстрый запрос)."""
         if not self.sheet:
@@ -1,32 +1,134 @@
 # core/database.py
 from datetime import datetime, timedelta
 from typing import Dict, Optional, List
+import threading
+import functools
+import logging
 import json
 import os
 
+from core.db_manager import connect, apply_migrations, db_manager
+from core.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_FIELDS = ("id", "username", "created_at", "trial_used", "subscription_end", "has_paid", "balance")
+
+SQL_GET_SUBSCRIBER = (
+    "SELECT user_id, username, created_at, trial_used, subscription_end, has_paid, balance "
+    "FROM subscribers WHERE user_id = ?"
+)
+SQL_INSERT_SUBSCRIBER = (
+    "INSERT OR REPLACE INTO subscribers "
+    "(user_id, username, created_at, trial_used, subscription_end, has_paid, balance) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_SET_TRIAL = "UPDATE subscribers SET trial_used = 1, subscription_end = ? WHERE user_id = ?"
+SQL_SET_PAID = "UPDATE subscribers SET has_paid = 1, subscription_end = ? WHERE user_id = ?"
+SQL_INSERT_PAYMENT = (
+    "INSERT OR REPLACE INTO payments (id, user_id, amount, description, status, created_at) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+
+def in_db_thread(func):
+    """Выполняет синхронный метод Database в потоке БД DatabaseManager, не блокируя event loop."""
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        def call():
+            return func(self, *args, **kwargs)
+
+        call.__name__ = func.__name__
+        return await db_manager.run(call)
+    return wrapper
+
 
 class Database:
-    def __init__(self):
-        self.users_file = "users.json"
+    """Пользователи и платежи бота подписок.
+
+    Хранятся в SQLite (portfolio_bots.db): каждое изменение — одна атомарная
+    запись строки вместо перезаписи всего users.json. Публичные методы —
+    корутины: запросы выполняются в потоке БД, а не в event loop.
+    """
+
+    def __init__(self, db_path: str = "portfolio_bots.db", users_file: str = "users.json"):
+        self.db_path = db_path
+        self.users_file = users_file
+        self._lock = threading.Lock()
         self.load_data()
 
     def load_data(self):
-        """Загружаем данные из файла"""
+        """Открываем хранилище и один раз переносим данные из users.json"""
+        self._conn = connect(self.db_path)
+        # Таблицы subscribers и payments создаются миграцией схемы (core/db_manager.py)
+        with self._lock:
+            apply_migrations(self._conn)
+
         if os.path.exists(self.users_file):
-            with open(self.users_file, 'r') as f:
-                self.data = json.load(f)
-        else:
-            self.data = {"users": {}, "payments": {}, "trials": {}}
+            self.migrate_from_json(self.users_file)
+
+    def migrate_from_json(self, path: str):
+        """Переносит users.json в SQLite одной транзакцией и переименовывает файл"""
+        with open(path, 'r') as f:
+            data = json.load(f)
+
+        users = data.get("users", {})
+        payments = data.get("payments", {})
+        if data.get("trials"):
+            logger.warning(f"⚠️ В {path} есть записи trials — они хранятся в users и не переносятся отдельно")
 
-    def save_data(self):
-        """Сохраняем данные в файл"""
-        with open(self.users_file, 'w') as f:
-            json.dump(self.data, f, indent=2, default=str)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(SQL_INSERT_SUBSCRIBER, [
+                    (
+                        int(user.get("id", user_id)),
+                        user.get("username"),
+                        user.get("created_at"),
+                        int(bool(user.get("trial_used"))),
+                        user.get("subscription_end"),
+                        int(bool(user.get("has_paid"))),
+                        user.get("balance", 0)
+                    )
+                    for user_id, user in users.items()
+                ])
+                self._conn.executemany(SQL_INSERT_PAYMENT, [
+                    (
+                        payment_id,
+                        payment.get("user_id"),
+                        payment.get("amount"),
+                        payment.get("description"),
+                        payment.get("status"),
+                        payment.get("created_at")
+                    )
+                    for payment_id, payment in payments.items()
+                ])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
 
+        os.replace(path, f"{path}.migrated")
+        logger.info(f"✅ {path} перенесён в SQLite: {len(users)} пользователей, {len(payments)} платежей")
+
+    @traced("db")
+    @in_db_thread
     def get_user(self, user_id: int) -> Optional[Dict]:
         """Получаем пользователя по ID"""
-        return self.data["users"].get(str(user_id))
+        return self._get_user(user_id)
+
+    def _get_user(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(SQL_GET_SUBSCRIBER, (user_id,)).fetchone()
+        if not row:
+            return None
+        user = dict(zip(SUBSCRIBER_FIELDS, row))
+        user["trial_used"] = bool(user["trial_used"])
+        user["has_paid"] = bool(user["has_paid"])
+        return user
 
+    @traced("db")
+    @in_db_thread
     def create_user(self, user_id: int, username: str = None):
         """Создаем нового пользователя"""
         user_data = {
@@ -38,33 +140,35 @@ class Database:
             "has_paid": False,
             "balance": 0
         }
-        self.data["users"][str(user_id)] = user_data
-        self.save_data()
+        with self._lock:
+            self._conn.execute(SQL_INSERT_SUBSCRIBER, (
+                user_id, username, user_data["created_at"], 0, None, 0, 0
+            ))
         return user_data
 
+    @traced("db")
+    @in_db_thread
     def set_trial_used(self, user_id: int, days: int = 3):
         """Активируем trial период"""
-        user = self.get_user(user_id)
-        if user:
-            user["trial_used"] = True
-            user["subscription_end"] = (datetime.now() + timedelta(days=days)).isoformat()
-            self.save_data()
-            return True
-        return False
+        subscription_end = (datetime.now() + timedelta(days=days)).isoformat()
+        with self._lock:
+            cursor = self._conn.execute(SQL_SET_TRIAL, (subscription_end, user_id))
+        return cursor.rowcount > 0
 
+    @traced("db")
+    @in_db_thread
     def set_paid_subscription(self, user_id: int, days: int = 30):
         """Активируем платную подписку"""
-        user = self.get_user(user_id)
-        if user:
-            user["has_paid"] = True
-            user["subscription_end"] = (datetime.now() + timedelta(days=days)).isoformat()
-            self.save_data()
-            return True
-        return False
+        subscription_end = (datetime.now() + timedelta(days=days)).isoformat()
+        with self._lock:
+            cursor = self._conn.execute(SQL_SET_PAID, (subscription_end, user_id))
+        return cursor.rowcount > 0
 
+    @traced("db")
+    @in_db_thread
     def get_user_status(self, user_id: int) -> Dict:
         """Получаем статус пользователя"""
-        user = self.get_user(user_id)
+        user = self._get_user(user_id)
         if not user:
             return {"active": False, "type": "none", "days_left": 0}
 
@@ -77,6 +181,8 @@ class Database:
 
         return {"active": False, "type": "expired", "days_left": 0}
 
+    @traced("db")
+    @in_db_thread
     def add_payment(self, user_id: int, amount: float, description: str):
         """Добавляем запись о платеже"""
         payment_id = f"pay_{datetime.now().timestamp()}"
@@ -88,10 +194,17 @@ class Database:
             "status": "pending",
             "created_at": datetime.now().isoformat()
         }
-        self.data["payments"][payment_id] = payment
-        self.save_data()
+        with self._lock:
+            self._conn.execute(SQL_INSERT_PAYMENT, (
+                payment_id, user_id, amount, description, payment["status"], payment["created_at"]
+            ))
         return payment
 
+    def close(self):
+        """Закрываем соединение"""
+        with self._lock:
+            self._conn.close()
+
 
 # Глобальный экземпляр базы данных
-db = Database()
\ No newline at end of file
+db = Database()
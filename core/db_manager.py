@@ -1,141 +1,500 @@
 # core/db_manager.py
+import os
+import asyncio
 import sqlite3
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from core.metrics import SQLITE_QUERY_DURATION
+from core.tracing import span
+
 logger = logging.getLogger(__name__)
 
+# Буферизация user_actions: пачка пишется одним executemany по размеру или по таймеру
+ACTION_BATCH_SIZE = int(os.getenv("DB_ACTION_BATCH_SIZE", 500))
+ACTION_FLUSH_INTERVAL = float(os.getenv("DB_ACTION_FLUSH_INTERVAL", 0.5))
+# Сколько строк держать в буфере, если запись раз за разом не удаётся (старые отбрасываются)
+ACTION_BUFFER_LIMIT = int(os.getenv("DB_ACTION_BUFFER_LIMIT", 10 * ACTION_BATCH_SIZE))
+
+# Настройки соединения: WAL позволяет читать во время записи,
+# synchronous=NORMAL убирает fsync на каждый коммит (fsync только на checkpoint)
+# auto_vacuum=INCREMENTAL действует только для новой БД (до создания первой таблицы)
+SQLITE_PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+)
+
+# Запросы держим константами: sqlite3 кэширует подготовленные выражения по тексту SQL
+SQL_GET_USER_MODE = "SELECT current_mode FROM users WHERE user_id = ?"
+SQL_UPSERT_USER_MODE = (
+    "INSERT INTO users (user_id, username, current_mode, last_activity) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET "
+    "current_mode = excluded.current_mode, last_activity = excluded.last_activity, username = excluded.username"
+)
+SQL_INSERT_ACTION = "INSERT INTO user_actions (user_id, action_type, bot_mode, details) VALUES (?, ?, ?, ?)"
+SQL_UPSERT_COUNTER = (
+    "INSERT INTO user_action_counters (user_id, bot_mode, count, last_action_at) "
+    "VALUES (?, ?, ?, CURRENT_TIMESTAMP) "
+    "ON CONFLICT(user_id, bot_mode) DO UPDATE SET "
+    "count = count + excluded.count, last_action_at = excluded.last_action_at"
+)
+SQL_USER_BOT_STATS = "SELECT bot_mode, count FROM user_action_counters WHERE user_id = ?"
+SQL_REBUILD_COUNTERS = (
+    "INSERT INTO user_action_counters (user_id, bot_mode, count, last_action_at) "
+    "SELECT user_id, bot_mode, COUNT(*), MAX(created_at) FROM user_actions GROUP BY user_id, bot_mode"
+)
+# Пересчёт с учётом итогов по строкам, уже удалённым политикой хранения
+SQL_REBUILD_COUNTERS_WITH_ARCHIVE = (
+    "INSERT INTO user_action_counters (user_id, bot_mode, count, last_action_at) "
+    "SELECT user_id, bot_mode, SUM(count), MAX(last_action_at) FROM ("
+    "SELECT user_id, bot_mode, COUNT(*) AS count, MAX(created_at) AS last_action_at "
+    "FROM user_actions GROUP BY user_id, bot_mode "
+    "UNION ALL SELECT user_id, bot_mode, count, last_action_at FROM user_action_archive"
+    ") GROUP BY user_id, bot_mode"
+)
+SQL_USER_LAST_ACTIVITY = "SELECT last_activity FROM users WHERE user_id = ?"
+
+SQL_ROLLUP_OLD_ACTIONS = (
+    "INSERT INTO user_actions_daily (day, bot_mode, action_type, count) "
+    "SELECT date(created_at), bot_mode, action_type, COUNT(*) FROM user_actions "
+    "WHERE id IN (SELECT id FROM user_actions WHERE created_at < datetime('now', ?) ORDER BY id LIMIT ?) "
+    "GROUP BY date(created_at), bot_mode, action_type "
+    "ON CONFLICT(day, bot_mode, action_type) DO UPDATE SET count = count + excluded.count"
+)
+SQL_ARCHIVE_OLD_ACTIONS = (
+    "INSERT INTO user_action_archive (user_id, bot_mode, count, last_action_at) "
+    "SELECT user_id, bot_mode, COUNT(*), MAX(created_at) FROM user_actions "
+    "WHERE id IN (SELECT id FROM user_actions WHERE created_at < datetime('now', ?) ORDER BY id LIMIT ?) "
+    "GROUP BY user_id, bot_mode "
+    "ON CONFLICT(user_id, bot_mode) DO UPDATE SET count = count + excluded.count, "
+    "last_action_at = MAX(last_action_at, excluded.last_action_at)"
+)
+SQL_DELETE_OLD_ACTIONS = (
+    "DELETE FROM user_actions "
+    "WHERE id IN (SELECT id FROM user_actions WHERE created_at < datetime('now', ?) ORDER BY id LIMIT ?)"
+)
+SQL_RECENT_SEEN_UPDATES = "SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT ?"
+SQL_INSERT_SEEN_UPDATE = "INSERT OR IGNORE INTO seen_updates (update_id) VALUES (?)"
+SQL_TRIM_SEEN_UPDATES = (
+    "DELETE FROM seen_updates WHERE update_id < "
+    "(SELECT MIN(update_id) FROM (SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT ?))"
+)
+
+# Версионированные миграции схемы: номер версии хранится в PRAGMA user_version.
+# Новые изменения схемы добавляются в конец списка со следующим номером.
+SCHEMA_MIGRATIONS = [
+    (1, [
+        # Таблица пользователей и их режимов
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            current_mode TEXT DEFAULT 'subscription',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Таблица для логов действий (для демо аналитики)
+        '''
+        CREATE TABLE IF NOT EXISTS user_actions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action_type TEXT,
+            bot_mode TEXT,
+            details TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+        # Таблица для демо-данных бота подписок
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            subscription_type TEXT,
+            start_date TIMESTAMP,
+            end_date TIMESTAMP,
+            status TEXT DEFAULT 'active',
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+    ]),
+    (2, [
+        # Покрывающий индекс для get_user_stats (WHERE user_id = ? GROUP BY bot_mode)
+        "CREATE INDEX IF NOT EXISTS idx_user_actions_user_mode ON user_actions (user_id, bot_mode)",
+        # Выборки и чистка по времени
+        "CREATE INDEX IF NOT EXISTS idx_user_actions_created_at ON user_actions (created_at)",
+    ]),
+    (3, [
+        # Материализованные счётчики действий: статистика за O(режимов), а не O(действий)
+        '''
+        CREATE TABLE IF NOT EXISTS user_action_counters (
+            user_id INTEGER NOT NULL,
+            bot_mode TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            last_action_at TIMESTAMP,
+            PRIMARY KEY (user_id, bot_mode)
+        ) WITHOUT ROWID
+        ''',
+        SQL_REBUILD_COUNTERS,
+    ]),
+    (4, [
+        # Дневные агрегаты для сырых действий, удалённых по сроку хранения
+        '''
+        CREATE TABLE IF NOT EXISTS user_actions_daily (
+            day TEXT NOT NULL,
+            bot_mode TEXT NOT NULL,
+            action_type TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, bot_mode, action_type)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (5, [
+        # Окно обработанных update_id для дедупликации между перезапусками
+        "CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY)",
+    ]),
+    (6, [
+        # Итоги по пользователям для удалённых по сроку действий: rebuild_counters их не теряет
+        '''
+        CREATE TABLE IF NOT EXISTS user_action_archive (
+            user_id INTEGER NOT NULL,
+            bot_mode TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            last_action_at TIMESTAMP,
+            PRIMARY KEY (user_id, bot_mode)
+        ) WITHOUT ROWID
+        ''',
+        # Уже удалённое до этой миграции восстанавливаем как разницу счётчиков и сырых строк
+        '''
+        INSERT INTO user_action_archive (user_id, bot_mode, count, last_action_at)
+        SELECT c.user_id, c.bot_mode, c.count - COALESCE(r.count, 0), c.last_action_at
+        FROM user_action_counters c
+        LEFT JOIN (
+            SELECT user_id, bot_mode, COUNT(*) AS count FROM user_actions GROUP BY user_id, bot_mode
+        ) r ON r.user_id = c.user_id AND r.bot_mode = c.bot_mode
+        WHERE c.count > COALESCE(r.count, 0)
+        ''',
+    ]),
+    (7, [
+        # FSM-состояния aiogram (core/fsm_storage.py)
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)",
+    ]),
+    (8, [
+        # Пользователи и платежи бота подписок (core/database.py)
+        '''
+        CREATE TABLE IF NOT EXISTS subscribers (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            created_at TEXT,
+            trial_used INTEGER DEFAULT 0,
+            subscription_end TEXT,
+            has_paid INTEGER DEFAULT 0,
+            balance NUMERIC DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            amount NUMERIC,
+            description TEXT,
+            status TEXT,
+            created_at TEXT
+        )
+        ''',
+    ]),
+    (9, [
+        # Постоянный уровень кэша генерации (core/generation_cache.py)
+        "CREATE TABLE IF NOT EXISTS generation_cache (key TEXT PRIMARY KEY, content TEXT NOT NULL, expires_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_generation_cache_expires ON generation_cache (expires_at)",
+    ]),
+]
+
+
+def apply_migrations(conn: sqlite3.Connection, target: int = None) -> int:
+    """Применяет недостающие миграции (до target включительно) и возвращает версию схемы."""
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, statements in SCHEMA_MIGRATIONS:
+        if version <= current or (target is not None and version > target):
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Миграцию мог уже применить другой процесс (воркер) с тем же файлом БД
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.execute("COMMIT")
+                current = version
+                continue
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        current = version
+        logger.info(f"✅ Схема БД обновлена до v{version}")
+    return current
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """Открывает долгоживущее соединение с настроенными PRAGMA.
+
+    isolation_level=None — транзакции открываем явно (BEGIN/COMMIT),
+    чтобы объединять несколько записей в одну.
+    """
+    conn = sqlite3.connect(
+        db_path,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=256
+    )
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _run_transaction(conn: sqlite3.Connection, statements):
+    """Выполняет [(sql, params), ...] одной транзакцией.
+
+    BEGIN — вне try: если он не удался (database is locked), откатывать нечего.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for sql, params in statements:
+            conn.execute(sql, params)
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def _resolve(future: asyncio.Future, result=None, error: Exception = None):
+    """Завершает future в потоке event loop."""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
 
 class DatabaseManager:
     def __init__(self, db_path="portfolio_bots.db"):
         self.db_path = db_path
-        self.init_database()
+
+        # Одно соединение и один поток: все обращения к SQLite идут через него
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+
+        # Записи от параллельных хендлеров копятся здесь и коммитятся одной транзакцией
+        self._pending_writes = []
+        self._pending_lock = threading.Lock()
+        self._commit_scheduled = False
+
+        # Буфер строк user_actions
+        self._action_buffer = []
+        self._action_lock = threading.Lock()
+        self._action_flush_handle = None
+
+        self._executor.submit(self.init_database).result()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Соединение живёт в потоке executor'а и создаётся один раз."""
+        if self._conn is None:
+            self._conn = connect(self.db_path)
+        return self._conn
 
     def init_database(self):
-        """Создаём таблицы при первом запуске"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """Создаём таблицы при первом запуске и обновляем схему существующей БД"""
+        version = apply_migrations(self._connection())
+        logger.info(f"✅ База данных инициализирована (схема v{version})")
 
-        # Таблица пользователей и их режимов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                current_mode TEXT DEFAULT 'subscription',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+    # === ВЫПОЛНЕНИЕ В ПОТОКЕ БД ===
+    async def _call(self, func, *args):
+        """Выполняет функцию в потоке БД, не блокируя event loop."""
+        loop = asyncio.get_running_loop()
+        with span("db_manager"):
+            return await loop.run_in_executor(self._executor, self._timed, func, *args)
 
-        # Таблица для логов действий (для демо аналитики)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_actions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                action_type TEXT,
-                bot_mode TEXT,
-                details TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
+    async def run(self, func, *args):
+        """Выполняет синхронную функцию в потоке БД (для кода вне DatabaseManager)."""
+        return await self._call(func, *args)
 
-        # Таблица для демо-данных бота подписок
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                subscription_type TEXT,
-                start_date TIMESTAMP,
-                end_date TIMESTAMP,
-                status TEXT DEFAULT 'active',
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных инициализирована")
-
-    def get_user_mode(self, user_id: int) -> str:
+    @staticmethod
+    def _timed(func, *args):
+        """Выполняет функцию в потоке БД и пишет её время в метрики."""
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            SQLITE_QUERY_DURATION.observe(time.perf_counter() - started, op=func.__name__)
+
+    async def _write(self, statements: list):
+        """Ставит в очередь группу выражений [(sql, params), ...] и ждёт коммита.
+
+        Пока поток БД занят, записи от других хендлеров накапливаются
+        и коммитятся следующей общей транзакцией (group commit).
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._pending_lock:
+            self._pending_writes.append((statements, future, loop))
+            schedule = not self._commit_scheduled
+            self._commit_scheduled = True
+        if schedule:
+            self._executor.submit(self._timed, self._commit_pending)
+        with span("db_manager"):
+            return await future
+
+    def _commit_pending(self):
+        """Коммитит все накопленные записи одной транзакцией (в потоке БД)."""
+        with self._pending_lock:
+            batch, self._pending_writes = self._pending_writes, []
+            self._commit_scheduled = False
+        if not batch:
+            return
+
+        try:
+            conn = self._connection()
+            try:
+                _run_transaction(conn, [sql_params for statements, _, _ in batch for sql_params in statements])
+            except Exception as e:
+                logger.warning(f"⚠️ Групповой коммит не удался, пишу по одной: {e}")
+                # Изолируем ошибку: каждая группа — в своей транзакции
+                for statements, future, loop in batch:
+                    try:
+                        _run_transaction(conn, statements)
+                        loop.call_soon_threadsafe(_resolve, future)
+                    except Exception as error:
+                        loop.call_soon_threadsafe(_resolve, future, None, error)
+                return
+        except Exception as error:
+            # Каждый ожидающий должен получить результат, иначе хендлер повиснет навсегда
+            for _, future, loop in batch:
+                loop.call_soon_threadsafe(_resolve, future, None, error)
+            return
+
+        for _, future, loop in batch:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    # === ПУБЛИЧНОЕ API ===
+    async def get_user_mode(self, user_id: int) -> str:
         """Получить текущий режим бота для пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        def select_user_mode():
+            result = self._connection().execute(SQL_GET_USER_MODE, (user_id,)).fetchone()
+            return result[0] if result else "subscription"
 
-        cursor.execute(
-            "SELECT current_mode FROM users WHERE user_id = ?",
-            (user_id,)
-        )
-        result = cursor.fetchone()
-        conn.close()
+        return await self._call(select_user_mode)
 
-        return result[0] if result else "subscription"
+    async def set_user_mode(self, user_id: int, username: str, mode: str):
+        """Установить режим бота для пользователя (атомарный UPSERT)"""
+        await self._write([(SQL_UPSERT_USER_MODE, (user_id, username, mode, datetime.now().isoformat()))])
 
-    def set_user_mode(self, user_id: int, username: str, mode: str):
-        """Установить режим бота для пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    async def log_action(self, user_id: int, action_type: str, bot_mode: str, details: str = ""):
+        """Логируем действие пользователя (в буфер, запись — пачкой)"""
+        with self._action_lock:
+            self._action_buffer.append((user_id, action_type, bot_mode, details))
+            buffered = len(self._action_buffer)
 
-        # Проверяем, существует ли пользователь
-        cursor.execute(
-            "SELECT user_id FROM users WHERE user_id = ?",
-            (user_id,)
-        )
+        if buffered >= ACTION_BATCH_SIZE:
+            # Буфер полон — пишем сразу и ждём, чтобы не копить бесконечно
+            await self._call(self._flush_actions)
+        elif self._action_flush_handle is None:
+            self._arm_flush_timer(asyncio.get_running_loop())
 
-        if cursor.fetchone():
-            # Обновляем существующего
-            cursor.execute(
-                "UPDATE users SET current_mode = ?, last_activity = ?, username = ? WHERE user_id = ?",
-                (mode, datetime.now().isoformat(), username, user_id)
-            )
-        else:
-            # Создаём нового
-            cursor.execute(
-                "INSERT INTO users (user_id, username, current_mode, last_activity) VALUES (?, ?, ?, ?)",
-                (user_id, username, mode, datetime.now().isoformat())
-            )
-
-        conn.commit()
-        conn.close()
-
-    def log_action(self, user_id: int, action_type: str, bot_mode: str, details: str = ""):
-        """Логируем действие пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute(
-            '''INSERT INTO user_actions 
-               (user_id, action_type, bot_mode, details) 
-               VALUES (?, ?, ?, ?)''',
-            (user_id, action_type, bot_mode, details)
-        )
+    def _arm_flush_timer(self, loop: asyncio.AbstractEventLoop):
+        """Планирует запись буфера через ACTION_FLUSH_INTERVAL (в потоке event loop)."""
+        if self._action_flush_handle is None:
+            self._action_flush_handle = loop.call_later(ACTION_FLUSH_INTERVAL, self._flush_by_timer, loop)
+
+    def _flush_by_timer(self, loop: asyncio.AbstractEventLoop):
+        self._action_flush_handle = None
+        future = self._executor.submit(self._timed, self._flush_actions)
+        future.add_done_callback(lambda f: self._on_timer_flush_done(f, loop))
+
+    def _on_timer_flush_done(self, future, loop: asyncio.AbstractEventLoop):
+        """Ошибку фоновой записи некому прочитать — логируем и повторяем по таймеру."""
+        if future.cancelled() or future.exception() is None:
+            return
+        logger.error(f"❌ Фоновая запись действий не удалась: {future.exception()}")
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self._arm_flush_timer, loop)
 
-        conn.commit()
-        conn.close()
+    def _flush_actions(self):
+        """Пишет буфер user_actions и счётчики одной транзакцией через executemany (в потоке БД)."""
+        with self._action_lock:
+            rows, self._action_buffer = self._action_buffer, []
+        if not rows:
+            return
 
-    def get_user_stats(self, user_id: int) -> dict:
+        # Счётчики обновляем в той же транзакции, что и сырые строки
+        counters = {}
+        for user_id, _, bot_mode, _ in rows:
+            counters[(user_id, bot_mode)] = counters.get((user_id, bot_mode), 0) + 1
+
+        conn = self._connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(SQL_INSERT_ACTION, rows)
+            conn.executemany(SQL_UPSERT_COUNTER, [
+                (user_id, bot_mode, count) for (user_id, bot_mode), count in counters.items()
+            ])
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            self._requeue_actions(rows)
+            logger.error(f"❌ Не удалось записать {len(rows)} действий, вернул в буфер: {e}")
+            raise
+
+    def _requeue_actions(self, rows: list):
+        """Возвращает неудачную пачку в начало буфера, не превышая ACTION_BUFFER_LIMIT."""
+        with self._action_lock:
+            self._action_buffer[:0] = rows
+            overflow = len(self._action_buffer) - ACTION_BUFFER_LIMIT
+            if overflow > 0:
+                del self._action_buffer[:overflow]
+        if overflow > 0:
+            logger.error(f"❌ Буфер действий переполнен, отброшено {overflow} старых строк")
+
+    async def flush(self):
+        """Принудительно записывает буфер действий и ожидающие записи (для shutdown и тестов)."""
+        if self._action_flush_handle is not None:
+            self._action_flush_handle.cancel()
+            self._action_flush_handle = None
+        await self._call(self._flush_actions)
+        await self._call(self._commit_pending)
+
+    async def get_user_stats(self, user_id: int) -> dict:
         """Получить статистику пользователя (для демо)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Количество действий по ботам
-        cursor.execute('''
-            SELECT bot_mode, COUNT(*) as count 
-            FROM user_actions 
-            WHERE user_id = ? 
-            GROUP BY bot_mode
-        ''', (user_id,))
-
-        bot_stats = {row[0]: row[1] for row in cursor.fetchall()}
-
-        # Последняя активность
-        cursor.execute(
-            "SELECT last_activity FROM users WHERE user_id = ?",
-            (user_id,)
-        )
-        last_activity = cursor.fetchone()
+        def select_user_stats():
+            conn = self._connection()
 
-        conn.close()
+            # Количество действий по ботам
+            bot_stats = {row[0]: row[1] for row in conn.execute(SQL_USER_BOT_STATS, (user_id,))}
+
+            # Последняя активность
+            last_activity = conn.execute(SQL_USER_LAST_ACTIVITY, (user_id,)).fetchone()
+            return bot_stats, last_activity
+
+        bot_stats, last_activity = await self._call(select_user_stats)
 
         return {
             "bot_usage": bot_stats,
@@ -143,6 +502,152 @@ class DatabaseManager:
             "total_actions": sum(bot_stats.values())
         }
 
+    async def rebuild_counters(self):
+        """Пересчитывает user_action_counters по сырым строкам user_actions.
+
+        Строки, удалённые политикой хранения (core/retention.py), берутся из user_action_archive.
+        """
+        def rebuild_counters():
+            self._flush_actions()
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM user_action_counters")
+                conn.execute(SQL_REBUILD_COUNTERS_WITH_ARCHIVE)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        await self._call(rebuild_counters)
+        logger.info("✅ Счётчики действий пересчитаны")
+
+    async def rollup_old_actions(self, older_than_days: int, batch_size: int) -> int:
+        """Сворачивает пачку сырых действий старше срока в дневные агрегаты и итоги по пользователям, затем удаляет её.
+
+        Агрегация и удаление — в одной короткой транзакции, поэтому писатели
+        блокируются не дольше, чем на одну пачку. Возвращает число удалённых строк.
+        """
+        def rollup_old_actions():
+            modifier = f"-{older_than_days} days"
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(SQL_ROLLUP_OLD_ACTIONS, (modifier, batch_size))
+                conn.execute(SQL_ARCHIVE_OLD_ACTIONS, (modifier, batch_size))
+                deleted = conn.execute(SQL_DELETE_OLD_ACTIONS, (modifier, batch_size)).rowcount
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return deleted
+
+        return await self._call(rollup_old_actions)
+
+    async def load_seen_updates(self, limit: int) -> list:
+        """Последние limit обработанных update_id в порядке возрастания."""
+        def select_seen_updates():
+            rows = self._connection().execute(SQL_RECENT_SEEN_UPDATES, (limit,)).fetchall()
+            return [row[0] for row in reversed(rows)]
+
+        return await self._call(select_seen_updates)
+
+    async def save_seen_updates(self, update_ids: list, keep: int):
+        """Добавляет update_id в сохранённое окно и оставляет в нём последние keep.
+
+        Окно дополняется, а не перезаписывается: его сохраняет каждый воркер.
+        """
+        def save_seen_updates():
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(SQL_INSERT_SEEN_UPDATE, ((update_id,) for update_id in update_ids))
+                conn.execute(SQL_TRIM_SEEN_UPDATES, (keep,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        await self._call(save_seen_updates)
+
+    async def mark_update_seen(self, update_id: int, keep: int) -> bool:
+        """Отмечает update_id в общем окне: True — апдейт новый, False — его уже обработал другой воркер.
+
+        Окно подрезается до последних keep раз в keep апдейтов.
+        """
+        def mark_update_seen():
+            conn = self._connection()
+            inserted = conn.execute(SQL_INSERT_SEEN_UPDATE, (update_id,)).rowcount == 1
+            if inserted and update_id % keep == 0:
+                conn.execute(SQL_TRIM_SEEN_UPDATES, (keep,))
+            return inserted
+
+        return await self._call(mark_update_seen)
+
+    async def ping(self) -> bool:
+        """Проверка доступности БД через поток БД (для health-проверок)."""
+        def ping():
+            return self._connection().execute("SELECT 1").fetchone()[0] == 1
+
+        return await self._call(ping)
+
+    async def incremental_vacuum(self, pages: int) -> bool:
+        """Возвращает ОС до pages свободных страниц (только при auto_vacuum=INCREMENTAL)."""
+        def incremental_vacuum():
+            conn = self._connection()
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return False
+            conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            return True
+
+        return await self._call(incremental_vacuum)
+
+    async def vacuum(self):
+        """Полный VACUUM с переводом БД в auto_vacuum=INCREMENTAL (разовая операция)."""
+        def full_vacuum():
+            conn = self._connection()
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+
+        await self._call(full_vacuum)
+        logger.info("✅ VACUUM выполнен, auto_vacuum=INCREMENTAL")
+
+    def close(self):
+        """Закрывает соединение и поток БД."""
+        if self._action_flush_handle is not None:
+            self._action_flush_handle.cancel()
+            self._action_flush_handle = None
+
+        def shutdown():
+            try:
+                self._flush_actions()
+            except Exception as e:
+                logger.error(f"❌ Действия не записаны при остановке: {e}")
+            self._commit_pending()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+        self._executor.submit(shutdown).result()
+        self._executor.shutdown(wait=True)
+        logger.info("✅ Соединение с БД закрыто")
+
 
 # Глобальный экземпляр
-db_manager = DatabaseManager()
\ No newline at end of file
+db_manager = DatabaseManager()
+
+
+if __name__ == "__main__":
+    # python -m core.db_manager rebuild-counters | vacuum
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    commands = {
+        "rebuild-counters": db_manager.rebuild_counters,
+        "vacuum": db_manager.vacuum,
+    }
+    if len(sys.argv) == 2 and sys.argv[1] in commands:
+        asyncio.run(commands[sys.argv[1]]())
+        db_manager.close()
+    else:
+        print("Использование: python -m core.db_manager rebuild-counters | vacuum")
@@ -0,0 +1,61 @@
+# core/dedup.py
+"""Дедупликация апдейтов по update_id: скользящее окно последних обработанных id."""
+import os
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних update_id помнить (повторные доставки приходят в пределах минут)
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", 10000))
+
+
+class UpdateDeduplicator:
+    """Кольцевой буфер + множество: проверка и добавление за O(1), память O(окна)."""
+
+    def __init__(self, window: int = DEDUP_WINDOW):
+        self.window = window
+        self._order = deque()
+        self._seen = set()
+        self.suppressed = 0
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def check_and_add(self, update_id: int) -> bool:
+        """True — апдейт новый (и запомнен), False — дубликат."""
+        if update_id in self._seen:
+            self.suppressed += 1
+            return False
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.window:
+            self._seen.discard(self._order.popleft())
+        return True
+
+    async def check_and_add_shared(self, update_id: int, manager) -> bool:
+        """Как check_and_add, но с проверкой общего окна в SQLite (режим нескольких воркеров).
+
+        Повторная доставка может прийти в другой процесс, локального окна для этого мало.
+        """
+        if not self.check_and_add(update_id):
+            return False
+        if not await manager.mark_update_seen(update_id, self.window):
+            self.suppressed += 1
+            return False
+        return True
+
+    async def load(self, manager):
+        """Восстанавливает окно из SQLite (вызывается из on_startup)."""
+        for update_id in await manager.load_seen_updates(self.window):
+            self.check_and_add(update_id)
+        logger.info(f"✅ Окно дедупликации восстановлено: {len(self)} update_id")
+
+    async def save(self, manager):
+        """Сохраняет окно в SQLite (вызывается из on_shutdown)."""
+        await manager.save_seen_updates(list(self._order), self.window)
+        logger.info(f"✅ Окно дедупликации сохранено: {len(self)} update_id, дубликатов отброшено: {self.suppressed}")
+
+
+# Глобальный экземпляр
+update_deduplicator = UpdateDeduplicator()
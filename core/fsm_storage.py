@@ -0,0 +1,269 @@
+# core/fsm_storage.py
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from core.db_manager import connect, apply_migrations
+
+logger = logging.getLogger(__name__)
+
+# Состояния старше TTL считаются устаревшими и удаляются
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", 24 * 3600))
+# Период записи изменённых состояний на диск (write-behind); 0 — запись сразу (write-through)
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 1.0))
+# Размер кэша и время жизни записи в нём (чтобы видеть изменения других воркеров)
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 10000))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", 30))
+FSM_CLEANUP_INTERVAL = float(os.getenv("FSM_CLEANUP_INTERVAL", 3600))
+# Как часто пересчитывать число пользователей по состояниям для /metrics
+FSM_COUNTS_INTERVAL = float(os.getenv("FSM_COUNTS_INTERVAL", 15))
+
+SQL_GET_FSM = "SELECT state, data, updated_at FROM fsm_states WHERE key = ?"
+SQL_UPSERT_FSM = (
+    "INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at"
+)
+SQL_DELETE_FSM = "DELETE FROM fsm_states WHERE key = ?"
+SQL_DELETE_STALE_FSM = "DELETE FROM fsm_states WHERE updated_at < ?"
+SQL_COUNT_FSM_STATES = (
+    "SELECT state, COUNT(*) FROM fsm_states WHERE state IS NOT NULL AND updated_at >= ? GROUP BY state"
+)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в SQLite (WAL) с кэшем и отложенной записью.
+
+    Чтения обслуживаются из кэша, изменения копятся и раз в FSM_FLUSH_INTERVAL
+    пишутся одной транзакцией (при 0 — до возврата из set_state/set_data).
+    Состояния переживают рестарт и доступны всем воркерам.
+    """
+
+    def __init__(self, db_path: str = "portfolio_bots.db"):
+        self.db_path = db_path
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+
+        self._lock = threading.Lock()
+        self._conn = connect(db_path)
+        # Таблица fsm_states создаётся миграцией схемы (core/db_manager.py)
+        apply_migrations(self._conn)
+
+        self._cache = OrderedDict()  # key -> [state, data, updated_at, cached_at]
+        self._dirty = set()
+        # Ключи, чья запись на диск ещё не закоммичена: как и изменённые, с диска не перечитываются
+        self._writing = set()
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._last_cleanup = 0.0
+        # Снимок для /metrics: считается в потоке, сбор метрик не ждёт SQLite
+        self._state_counts = {}
+        self._counts_at = float("-inf")
+        self._counts_task = None
+
+    # === КЭШ ===
+    async def _load(self, key: str) -> list:
+        """Возвращает запись из кэша или с диска."""
+        now = time.time()
+        entry = self._cache.get(key)
+        if entry is None or (not self._is_pinned(key) and now - entry[3] > FSM_CACHE_TTL):
+            row = await asyncio.to_thread(self._select, key)
+            if self._is_pinned(key) and key in self._cache:
+                # Пока шло чтение, запись изменили в памяти — она новее строки с диска
+                entry = self._cache[key]
+            else:
+                if row is not None and now - row[2] <= FSM_STATE_TTL:
+                    entry = [row[0], json.loads(row[1]), row[2], now]
+                else:
+                    entry = [None, {}, now, now]
+                self._remember(key, entry)
+        else:
+            self._cache.move_to_end(key)
+
+        # Устаревшее состояние: пользователь давно ушёл из диалога
+        if now - entry[2] > FSM_STATE_TTL:
+            entry[0], entry[1] = None, {}
+        return entry
+
+    def _remember(self, key: str, entry: list):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > FSM_CACHE_SIZE:
+            # Вытесняем самую старую запись, кроме несохранённых
+            for old_key in self._cache:
+                if not self._is_pinned(old_key):
+                    break
+            else:
+                break
+            del self._cache[old_key]
+
+    def _is_pinned(self, key: str) -> bool:
+        """Запись изменена в памяти и ещё не закоммичена на диск."""
+        return key in self._dirty or key in self._writing
+
+    def _select(self, key: str):
+        with self._lock:
+            return self._conn.execute(SQL_GET_FSM, (key,)).fetchone()
+
+    async def _save(self, key: str):
+        """Отмечает запись изменённой; при FSM_FLUSH_INTERVAL=0 дожидается коммита.
+
+        Write-through нужен воркерам: следующий апдейт чата может попасть в другой процесс.
+        """
+        if FSM_FLUSH_INTERVAL > 0:
+            self._mark_dirty(key)
+            return
+        self._dirty.add(key)
+        if not await self.flush():
+            raise RuntimeError(f"FSM-состояние {key} не сохранено")
+
+    def _mark_dirty(self, key: str):
+        self._dirty.add(key)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Изменения, сделанные во время записи, уходят следующим циклом
+        while self._dirty:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """Записывает изменённые состояния одной транзакцией (записи идут по очереди).
+
+        False — запись не удалась, изменения остались в очереди.
+        """
+        async with self._flush_lock:
+            if not self._dirty:
+                return True
+            keys, self._dirty = self._dirty, set()
+            self._writing = keys
+            rows = []
+            for key in keys:
+                entry = self._cache.get(key)
+                if entry is not None:
+                    rows.append((key, entry[0], json.dumps(entry[1], ensure_ascii=False, default=str), entry[2]))
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception as e:
+                self._dirty |= keys
+                logger.error(f"❌ Не удалось сохранить FSM-состояния: {e}")
+                return False
+            finally:
+                self._writing = set()
+            return True
+
+    def _write(self, rows: list):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Пустые записи удаляем, остальные обновляем
+                self._conn.executemany(SQL_DELETE_FSM, [(row[0],) for row in rows if row[1] is None and row[2] == "{}"])
+                self._conn.executemany(SQL_UPSERT_FSM, [row for row in rows if row[1] is not None or row[2] != "{}"])
+                if now - self._last_cleanup > FSM_CLEANUP_INTERVAL:
+                    self._conn.execute(SQL_DELETE_STALE_FSM, (now - FSM_STATE_TTL,))
+                    self._last_cleanup = now
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # === API BaseStorage ===
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        entry = await self._load(storage_key)
+        entry[0] = state.state if isinstance(state, State) else state
+        # Запись в памяти — самая свежая версия, перечитывать её с диска рано
+        entry[2] = entry[3] = time.time()
+        await self._save(storage_key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        entry = await self._load(self.key_builder.build(key))
+        return entry[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key = self.key_builder.build(key)
+        entry = await self._load(storage_key)
+        entry[1] = dict(data)
+        entry[2] = entry[3] = time.time()
+        await self._save(storage_key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        entry = await self._load(self.key_builder.build(key))
+        return dict(entry[1])
+
+    # === МЕТРИКИ ===
+    def get_state_counts(self) -> Dict[str, int]:
+        """Сколько пользователей в каждом состоянии (последний снимок, обновляется в фоне).
+
+        Снимок не старше FSM_COUNTS_INTERVAL плюс задержка записи FSM_FLUSH_INTERVAL.
+        """
+        now = time.monotonic()
+        if now - self._counts_at >= FSM_COUNTS_INTERVAL and (self._counts_task is None or self._counts_task.done()):
+            self._counts_at = now
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Вызов из потока (сброс метрик воркера): event loop не блокируется
+                self._state_counts = self._count_states()
+            else:
+                self._counts_task = loop.create_task(self._refresh_state_counts())
+        return self._state_counts
+
+    async def _refresh_state_counts(self):
+        try:
+            self._state_counts = await asyncio.to_thread(self._count_states)
+        except Exception as e:
+            logger.error(f"❌ Не удалось посчитать FSM-состояния: {e}")
+
+    def _count_states(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute(SQL_COUNT_FSM_STATES, (time.time() - FSM_STATE_TTL,)).fetchall())
+
+    async def close(self) -> None:
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        if self._counts_task is not None and not self._counts_task.done():
+            await self._counts_task
+        await self.flush()
+        with self._lock:
+            self._conn.close()
+        logger.info("✅ FSM-хранилище закрыто")
+
+
+class KeyedEventIsolation(BaseEventIsolation):
+    """Изоляция событий aiogram: апдейты с одним ключом FSM обрабатываются по очереди.
+
+    Замок берёт FSMContextMiddleware до чтения состояния, поэтому следующий апдейт
+    чата видит состояние, уже записанное предыдущим. В отличие от SimpleEventIsolation,
+    замки со счётчиком ссылок удаляются, когда апдейтов с этим ключом не остаётся.
+    """
+
+    def __init__(self):
+        self._locks: Dict[StorageKey, list] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            # [замок, число апдейтов в работе и в ожидании]
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def close(self) -> None:
+        self._locks.clear()
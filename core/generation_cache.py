@@ -0,0 +1,141 @@
+# core/generation_cache.py
+import os
+import re
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Параметры кэша сгенерированного контента
+CACHE_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", 1000))
+CACHE_TTL = float(os.getenv("GENERATION_CACHE_TTL", 24 * 3600))
+# Путь к SQLite для постоянного уровня кэша (пусто — только память)
+CACHE_DB_PATH = os.getenv("GENERATION_CACHE_DB", "")
+# Как часто удалять просроченные записи из SQLite
+CACHE_PURGE_INTERVAL = float(os.getenv("GENERATION_CACHE_PURGE_INTERVAL", 3600))
+
+SQL_GET_CACHED = "SELECT content, expires_at FROM generation_cache WHERE key = ?"
+SQL_PUT_CACHED = "INSERT OR REPLACE INTO generation_cache (key, content, expires_at) VALUES (?, ?, ?)"
+SQL_PURGE_CACHED = "DELETE FROM generation_cache WHERE expires_at <= ?"
+
+
+def normalize_topic(topic: str) -> str:
+    """Приводит тему к каноническому виду: регистр, пробелы, пунктуация по краям."""
+    topic = re.sub(r"\s+", " ", (topic or "").strip().lower())
+    return topic.strip(" .,!?;:\"'«»")
+
+
+def make_key(platform: str, model: str, prompt: str) -> str:
+    """Ключ записи: платформа, модель и хэш промпта."""
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return f"{platform}:{model}:{prompt_hash}"
+
+
+class GenerationCache:
+    """LRU-кэш с TTL в памяти и необязательным уровнем в SQLite."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL,
+                 db_path: str = CACHE_DB_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, content)
+        self._lock = threading.Lock()
+        # Отдельный замок соединения: запрос в потоке не блокирует кэш в памяти
+        self._db_lock = threading.Lock()
+        self._conn = None
+
+        # Метрики
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if db_path:
+            from core.db_manager import connect, apply_migrations
+            self._conn = connect(db_path)
+            # Таблица generation_cache создаётся миграцией схемы (core/db_manager.py)
+            apply_migrations(self._conn)
+
+    @property
+    def persistent(self) -> bool:
+        return self._conn is not None
+
+    async def get(self, key: str) -> Optional[str]:
+        """Возвращает контент по ключу или None; SQLite читается в потоке, не в event loop."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, content = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return content
+                del self._entries[key]
+
+        if self._conn is not None:
+            row = await asyncio.to_thread(self._select, key)
+            if row and row[1] > now:
+                with self._lock:
+                    self._store(key, row[0], row[1])
+                    self.persistent_hits += 1
+                return row[0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    async def set(self, key: str, content: str):
+        """Сохраняет контент (перезаписывает существующую запись)."""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store(key, content, expires_at)
+        if self._conn is not None:
+            await asyncio.to_thread(self._execute, SQL_PUT_CACHED, (key, content, expires_at))
+
+    async def purge_loop(self):
+        """Фоновая задача: периодически удаляет просроченные записи из SQLite."""
+        while True:
+            await asyncio.sleep(CACHE_PURGE_INTERVAL)
+            try:
+                deleted = await asyncio.to_thread(self._execute, SQL_PURGE_CACHED, (time.time(),))
+                if deleted:
+                    logger.info(f"🧹 Из кэша генерации удалено {deleted} просроченных записей")
+            except Exception as e:
+                logger.error(f"❌ Не удалось очистить кэш генерации: {e}")
+
+    def _select(self, key: str):
+        with self._db_lock:
+            return self._conn.execute(SQL_GET_CACHED, (key,)).fetchone()
+
+    def _execute(self, sql: str, params: tuple) -> int:
+        with self._db_lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def _store(self, key: str, content: str, expires_at: float):
+        self._entries[key] = (expires_at, content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_stats(self) -> dict:
+        """Счётчики попаданий/промахов."""
+        total = self.hits + self.persistent_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.persistent_hits) / total if total else 0.0
+        }
+
+
+# Глобальный экземпляр
+generation_cache = GenerationCache()
@@ -0,0 +1,162 @@
+# core/health.py
+"""Health-проверки: liveness отвечает сразу, readiness — из кэша фонового пробера."""
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", 30))
+HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", 5))
+# Очередь аналитики считается «забитой» с этого размера
+HEALTH_QUEUE_BACKLOG_LIMIT = int(os.getenv("HEALTH_QUEUE_BACKLOG_LIMIT", 5000))
+# Ошибка доставки вебхука старше этого окна (сек) считается устаревшей
+HEALTH_WEBHOOK_ERROR_WINDOW = float(os.getenv("HEALTH_WEBHOOK_ERROR_WINDOW", 600))
+
+_LIVE_BODY = json.dumps({"status": "ok"}).encode("utf-8")
+
+
+class ProbeFailed(Exception):
+    """Проверка не прошла; details попадают в ответ /health/ready."""
+
+    def __init__(self, message: str, **details):
+        super().__init__(message)
+        self.details = details
+
+
+class HealthProber:
+    """Периодически опрашивает зависимости и хранит готовый JSON-ответ readiness.
+
+    Критичные проверки (critical=True) при сбое переводят статус в fail (503),
+    остальные — в degraded (200).
+    """
+
+    def __init__(self, interval: float = HEALTH_PROBE_INTERVAL, timeout: float = HEALTH_PROBE_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout
+        self._checks = {}
+        self._task = None
+        self._body = json.dumps({"status": "starting", "checks": {}}).encode("utf-8")
+        self._status = 503
+
+    def add_check(self, name: str, probe, critical: bool = True):
+        """Регистрирует проверку: probe — корутина-функция, возвращает dict деталей или бросает исключение."""
+        self._checks[name] = (probe, critical)
+
+    async def _run_check(self, name: str) -> dict:
+        probe, critical = self._checks[name]
+        started = time.perf_counter()
+        try:
+            details = await asyncio.wait_for(probe(), self.timeout) or {}
+            result = {"ok": True, **details}
+        except ProbeFailed as e:
+            result = {"ok": False, "error": str(e), **e.details}
+        except asyncio.TimeoutError:
+            result = {"ok": False, "error": f"таймаут {self.timeout} с"}
+        except Exception as e:
+            result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        result["critical"] = critical
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+
+    async def probe_once(self):
+        """Опрашивает все зависимости параллельно и обновляет кэшированный ответ."""
+        names = list(self._checks)
+        results = dict(zip(names, await asyncio.gather(*(self._run_check(name) for name in names))))
+
+        if any(not r["ok"] and r["critical"] for r in results.values()):
+            status, code = "fail", 503
+        elif any(not r["ok"] for r in results.values()):
+            status, code = "degraded", 200
+        else:
+            status, code = "ok", 200
+        if code != self._status:
+            if code == 200:
+                logger.info(f"✅ Readiness: {status}")
+            else:
+                logger.warning(f"⚠️ Readiness: {status}")
+
+        self._body = json.dumps({
+            "status": status,
+            "checked_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "checks": results
+        }, ensure_ascii=False).encode("utf-8")
+        self._status = code
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.probe_once()
+            except Exception as e:
+                logger.error(f"❌ Ошибка health-пробера: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Запускает фоновый опрос (вызывается из on_startup)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def live(self, request: web.Request) -> web.Response:
+        """GET /health/live — процесс жив и event loop отвечает."""
+        return web.Response(body=_LIVE_BODY, content_type="application/json")
+
+    async def ready(self, request: web.Request) -> web.Response:
+        """GET /health/ready — последний результат опроса зависимостей (без сетевых запросов)."""
+        return web.Response(body=self._body, status=self._status, content_type="application/json")
+
+
+# === ПРОВЕРКИ ЗАВИСИМОСТЕЙ ===
+async def probe_webhook(bot) -> dict:
+    """Вебхук установлен и Telegram недавно не сообщал об ошибках доставки."""
+    info = await bot.get_webhook_info()
+    details = {"pending_updates": info.pending_update_count}
+    if not info.url:
+        raise ProbeFailed("вебхук не установлен", **details)
+    if info.last_error_date:
+        age = time.time() - info.last_error_date.timestamp()
+        if age < HEALTH_WEBHOOK_ERROR_WINDOW:
+            raise ProbeFailed(info.last_error_message or "ошибка доставки", error_age_s=round(age), **details)
+    return details
+
+
+async def probe_sqlite(manager) -> dict:
+    """SQLite отвечает через поток БД."""
+    await manager.ping()
+    return {}
+
+
+async def probe_sheets(analytics) -> dict:
+    """Google Sheets подключён и отвечает на чтение ячейки."""
+    if analytics.disabled:
+        raise ProbeFailed("аналитика отключена: credentials не настроены")
+    if not analytics.sheet:
+        raise ProbeFailed("нет подключения" if analytics.ready else "подключение ещё идёт")
+    if not await asyncio.to_thread(analytics.test_connection):
+        raise ProbeFailed("запрос к таблице не прошёл")
+    return {}
+
+
+async def probe_analytics_queue(analytics) -> dict:
+    """Очередь аналитики не накопила большой бэклог."""
+    details = {"queue_depth": analytics.queue_depth, "spooled_events": analytics.spooled_events}
+    if analytics.queue_depth >= HEALTH_QUEUE_BACKLOG_LIMIT:
+        raise ProbeFailed("бэклог очереди аналитики", limit=HEALTH_QUEUE_BACKLOG_LIMIT, **details)
+    return details
+
+
+# Глобальный экземпляр
+health_prober = HealthProber()
@@ -0,0 +1,62 @@
+# core/http_client.py
+import os
+import logging
+
+import aiohttp
+
+from core.tracing import http_trace_config
+
+logger = logging.getLogger(__name__)
+
+# Пул соединений для исходящих HTTP-запросов (OpenAI, self-ping)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 60))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 60))
+
+
+class HttpClient:
+    """Общая на всё приложение aiohttp-сессия: keep-alive, кэш DNS, таймауты."""
+
+    def __init__(self):
+        self._session = None
+
+    async def start(self):
+        """Создаёт сессию (вызывается из on_startup)."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                connect=HTTP_CONNECT_TIMEOUT,
+                sock_read=HTTP_READ_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                trace_configs=[http_trace_config()]
+            )
+            logger.info("✅ HTTP-сессия создана")
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("HTTP-сессия не запущена: вызовите http_client.start()")
+        return self._session
+
+    async def close(self):
+        """Закрывает сессию и все соединения пула (вызывается из on_shutdown)."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("✅ HTTP-сессия закрыта")
+        self._session = None
+
+
+# Глобальный экземпляр
+http_client = HttpClient()
@@ -0,0 +1,231 @@
+# core/metrics.py
+"""Метрики в формате Prometheus (text exposition) без внешних зависимостей."""
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Ограничение числа наборов меток на метрику (защита от «взрыва» кардинальности)
+MAX_LABEL_SETS = 500
+OTHER_LABEL = "other"
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        if key not in self._values and len(self._values) >= MAX_LABEL_SETS:
+            key = tuple(OTHER_LABEL for _ in self.labelnames)
+        return key
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> list:
+        lines = self.header()
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets=DEFAULT_BUCKETS,
+                 registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            state = self._values.get(key)
+            if state is None:
+                # [счётчики по корзинам, сумма, количество]
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self) -> list:
+        lines = self.header()
+        with self._lock:
+            for key, (bucket_counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Значение вычисляется при каждом сборе: func() -> число или {метки (tuple): число}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, func, labelnames: tuple = (), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.func = func
+
+    def collect(self) -> list:
+        lines = self.header()
+        value = self.func()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for key, item in items:
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {item}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: _Metric):
+        self._metrics[metric.name] = metric
+
+    def unregister(self, name: str):
+        self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        """Текст для эндпоинта /metrics."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.collect())
+            except Exception as e:
+                lines.append(f"# {metric.name} collect error: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+def merge_expositions(texts: dict, label: str) -> str:
+    """Объединяет выводы render() нескольких процессов, добавляя к сэмплам метку label.
+
+    texts — {значение метки: текст}; HELP/TYPE каждой метрики выводятся один раз.
+    """
+    families = {}
+    for value, text in texts.items():
+        extra = f'{label}="{_escape(value)}"'
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                name = line.split(" ", 3)[2]
+                family = families.setdefault(name, {"header": [], "samples": []})
+                if len(family["header"]) < 2:
+                    family["header"].append(line)
+                continue
+            if line.startswith("#") or family is None:
+                continue
+            name, sep, rest = line.partition("{")
+            if sep:
+                sample = f"{name}{{{extra},{rest}" if not rest.startswith("}") else f"{name}{{{extra}{rest}"
+            else:
+                name, _, number = line.partition(" ")
+                sample = f"{name}{{{extra}}} {number}"
+            family["samples"].append(sample)
+
+    lines = []
+    for family in families.values():
+        lines.extend(family["header"])
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# === МЕТРИКИ ПРИЛОЖЕНИЯ ===
+UPDATE_DURATION = Histogram(
+    "bot_update_duration_seconds", "Полное время обработки апдейта", ("event_type",)
+)
+HANDLER_DURATION = Histogram(
+    "bot_handler_duration_seconds", "Время хендлера по роутеру и callback_data", ("router", "event")
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в хендлерах", ("router", "event")
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Время HTTP-запросов к серверу", ("path", "status")
+)
+OPENAI_REQUEST_DURATION = Histogram(
+    "openai_request_duration_seconds", "Латентность запросов к OpenAI", ("status",),
+    buckets=(0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+)
+OPENAI_REQUESTS = Counter(
+    "openai_requests_total", "Запросы к OpenAI по коду ответа", ("status",)
+)
+SHEETS_FLUSH_DURATION = Histogram(
+    "sheets_flush_duration_seconds", "Латентность записи пачки в Google Sheets", ("result",)
+)
+SQLITE_QUERY_DURATION = Histogram(
+    "sqlite_query_duration_seconds", "Время операций SQLite в потоке БД", ("op",),
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+)
+WEBHOOK_UPDATES = Counter(
+    "webhook_updates_total", "Входящие апдейты вебхука по результату приёма", ("result",)
+)
+WEBHOOK_QUEUE_WAIT = Histogram(
+    "webhook_queue_wait_seconds", "Время апдейта во внутренней очереди до начала обработки"
+)
+CHAT_LANE_WAIT = Histogram(
+    "chat_lane_wait_seconds", "Ожидание апдейта в очереди своего чата (ChatLaneMiddleware)"
+)
+DUPLICATE_UPDATES = Counter(
+    "duplicate_updates_suppressed_total", "Повторно доставленные апдейты, отброшенные по update_id", ("event_type",)
+)
+TELEGRAM_SEND_WAIT = Histogram(
+    "telegram_send_wait_seconds", "Ожидание флуд-лимитов перед запросом к Bot API", ("method",)
+)
+TELEGRAM_RETRY_AFTER = Counter(
+    "telegram_retry_after_total", "Ответы Bot API с retry_after (TelegramRetryAfter)", ("method",)
+)
+TELEGRAM_EDITS_COALESCED = Counter(
+    "telegram_edits_coalesced_total", "Правки сообщения, склеенные с более поздней правкой"
+)
@@ -0,0 +1,209 @@
+# core/middlewares.py
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+from aiohttp import web
+
+from core.metrics import (
+    UPDATE_DURATION, HANDLER_DURATION, HANDLER_ERRORS, HTTP_REQUEST_DURATION, CHAT_LANE_WAIT,
+    DUPLICATE_UPDATES
+)
+from core.tracing import start_trace, finish_trace, span, webhook_received_at
+
+logger = logging.getLogger(__name__)
+
+
+def event_label(event: TelegramObject) -> str:
+    """Метка события: callback_data для кнопок, команда для сообщений."""
+    if isinstance(event, CallbackQuery):
+        return event.data or "callback"
+    if isinstance(event, Message):
+        if event.text and event.text.startswith("/"):
+            return event.text.split()[0].split("@")[0]
+        return "message"
+    return type(event).__name__
+
+
+def chat_key(update: Update) -> int:
+    """Ключ шардирования апдейта: chat_id, иначе id пользователя, иначе 0."""
+    context = UserContextMiddleware.resolve_event_context(update)
+    if context.chat_id is not None:
+        return context.chat_id
+    return context.user_id or 0
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: полное время обработки апдейта."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_DURATION.observe(time.perf_counter() - started, event_type=event.event_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware диспетчера: время хендлера по роутеру и callback_data/команде.
+
+    Inner-middleware родителя наследуются дочерними роутерами, поэтому
+    регистрируется один раз на dp, а роутер берётся из data["event_router"].
+    """
+
+    def __init__(self, router_names: Dict[Any, str]):
+        self.router_names = router_names
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        label = event_label(event)
+        router_name = self.router_names.get(data.get("event_router"), "other")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(router=router_name, event=label)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, router=router_name, event=label)
+
+
+class DedupMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: повторно доставленный update_id не доходит до хендлеров.
+
+    С manager (режим воркеров) окно общее для всех процессов и хранится в SQLite.
+    """
+
+    def __init__(self, deduplicator, manager=None):
+        self.deduplicator = deduplicator
+        self.manager = manager
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        if self.manager is not None:
+            is_new = await self.deduplicator.check_and_add_shared(event.update_id, self.manager)
+        else:
+            is_new = self.deduplicator.check_and_add(event.update_id)
+        if not is_new:
+            DUPLICATE_UPDATES.inc(event_type=event.event_type)
+            logger.info(f"♻️ Дубликат апдейта {event.update_id} отброшен")
+            return None
+        return await handler(event, data)
+
+
+class ChatLaneMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: апдейты одного чата — строго по очереди, разных чатов — параллельно.
+
+    На каждый активный чат заводится asyncio.Lock (FIFO) со счётчиком ссылок;
+    когда апдейтов чата не остаётся, замок удаляется.
+
+    Встроенный FSMContextMiddleware выполняется раньше и читает состояние до этого
+    замка, поэтому порядок FSM обеспечивает изоляция событий диспетчера
+    (KeyedEventIsolation), а lane упорядочивает остальное — в том числе апдейты
+    разных пользователей одного группового чата.
+    """
+
+    def __init__(self):
+        self._lanes: Dict[int, list] = {}
+
+    @property
+    def active_lanes(self) -> int:
+        return len(self._lanes)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        key = chat_key(event)
+        lane = self._lanes.get(key)
+        if lane is None:
+            # [замок, число апдейтов в работе и в ожидании]
+            lane = self._lanes[key] = [asyncio.Lock(), 0]
+        lane[1] += 1
+        started = time.perf_counter()
+        try:
+            with span("lane_wait"):
+                await lane[0].acquire()
+            CHAT_LANE_WAIT.observe(time.perf_counter() - started)
+            try:
+                return await handler(event, data)
+            finally:
+                lane[0].release()
+        finally:
+            lane[1] -= 1
+            if not lane[1]:
+                del self._lanes[key]
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: трассировка апдейта и slow-лог."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        trace, token = start_trace(event.update_id, event.event_type)
+        try:
+            return await handler(event, data)
+        finally:
+            user = data.get("event_from_user")
+            finish_trace(
+                trace, token,
+                event=event_label(event.event),
+                user_id=user.id if user else None
+            )
+
+
+class TelegramTracingMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: вызовы Bot API попадают в спан telegram.<Метод>."""
+
+    async def __call__(self, make_request, bot, method):
+        with span(f"telegram.{type(method).__name__}"):
+            return await make_request(bot, method)
+
+
+@web.middleware
+async def webhook_receipt_middleware(request: web.Request, handler):
+    """aiohttp-middleware: запоминает момент приёма запроса для трассировки апдейта."""
+    webhook_received_at.set(time.perf_counter())
+    return await handler(request)
+
+
+@web.middleware
+async def http_metrics_middleware(request: web.Request, handler):
+    """aiohttp-middleware: время ответа по маршруту и коду."""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        path = resource.canonical if resource is not None else "unmatched"
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, path=path, status=status)
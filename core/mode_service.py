@@ -0,0 +1,68 @@
+# core/mode_service.py
+import os
+import logging
+from collections import OrderedDict
+
+from core.db_manager import db_manager
+
+logger = logging.getLogger(__name__)
+
+MODE_CACHE_SIZE = int(os.getenv("MODE_CACHE_SIZE", 50000))
+
+
+class ModeService:
+    """Текущий режим пользователя: LRU-кэш с read-through/write-through поверх DatabaseManager."""
+
+    def __init__(self, manager, max_entries: int = MODE_CACHE_SIZE):
+        self.manager = manager
+        self.max_entries = max_entries
+        self._cache = OrderedDict()  # user_id -> mode
+
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get_mode(self, user_id: int) -> str:
+        """Режим из кэша, при промахе — из БД."""
+        mode = self._cache.get(user_id)
+        if mode is not None:
+            self._cache.move_to_end(user_id)
+            self.hits += 1
+            return mode
+
+        self.misses += 1
+        mode = await self.manager.get_user_mode(user_id)
+        self._store(user_id, mode)
+        return mode
+
+    async def set_mode(self, user_id: int, username: str, mode: str):
+        """Обновляет кэш и пишет режим в БД.
+
+        Кэш обновляется первым: если запись в БД не удалась,
+        пользователь всё равно видит выбранный режим до вытеснения.
+        """
+        self._store(user_id, mode)
+        await self.manager.set_user_mode(user_id, username, mode)
+
+    def _store(self, user_id: int, mode: str):
+        self._cache[user_id] = mode
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def get_stats(self) -> dict:
+        """Размер кэша и доля попаданий."""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+
+# Глобальный экземпляр
+mode_service = ModeService(db_manager)
@@ -0,0 +1,55 @@
+# core/profiling.py
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Профилирование холодного старта: STARTUP_PROFILE=1
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "0") == "1"
+# Куда дополнительно записать отчёт (JSON), если задано
+STARTUP_PROFILE_FILE = os.getenv("STARTUP_PROFILE_FILE", "")
+
+
+class StartupProfiler:
+    """Замеряет время фаз запуска и выдаёт структурированный отчёт."""
+
+    def __init__(self, enabled: bool = STARTUP_PROFILE):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """Контекстный менеджер для замера одной фазы."""
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+    def report(self) -> dict:
+        """Отчёт: общее время с импорта профайлера и время по фазам (секунды)."""
+        return {
+            "total": round(time.perf_counter() - self.started, 4),
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()}
+        }
+
+    def log_report(self):
+        """Пишет отчёт в лог (и в файл, если задан STARTUP_PROFILE_FILE)."""
+        if not self.enabled:
+            return
+        report = json.dumps(self.report(), ensure_ascii=False)
+        logger.info(f"⏱ STARTUP_PROFILE {report}")
+        if STARTUP_PROFILE_FILE:
+            with open(STARTUP_PROFILE_FILE, "w") as f:
+                f.write(report)
+
+
+# Глобальный экземпляр (создаётся первым импортом в main.py)
+startup_profiler = StartupProfiler()
@@ -0,0 +1,73 @@
+# core/ratelimit.py
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket: в среднем rate операций в секунду, всплески до capacity."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Забирает токены, если они есть, и возвращает 0; иначе — сколько секунд ждать."""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1):
+        """Ждёт, пока в ведре появятся токены."""
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class SingleFlight:
+    """Объединяет одновременные вызовы с одинаковым ключом в один."""
+
+    def __init__(self):
+        self._calls = {}  # key -> [задача, число ожидающих]
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        """Выполняет factory() один раз на ключ; остальные вызывающие ждут тот же результат.
+
+        Если все ожидающие отменены, общая задача тоже отменяется и освобождает
+        занятые ею семафор и лимиты.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(factory())
+            call = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            self.coalesced += 1
+
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if not call[1] and not call[0].done():
+                # Новый вызов с тем же ключом не должен получить отменённую задачу
+                self._forget(key, call)
+                call[0].cancel()
+
+    def _forget(self, key, call: list):
+        if self._calls.get(key) is call:
+            del self._calls[key]
@@ -0,0 +1,45 @@
+# core/retention.py
+import os
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Настройки хранения user_actions (0 дней — хранение без ограничений)
+RETENTION_DAYS = int(os.getenv("ACTIONS_RETENTION_DAYS", 30))
+RETENTION_BATCH_SIZE = int(os.getenv("ACTIONS_RETENTION_BATCH_SIZE", 5000))
+RETENTION_INTERVAL = float(os.getenv("ACTIONS_RETENTION_INTERVAL", 3600))
+RETENTION_BATCH_PAUSE = float(os.getenv("ACTIONS_RETENTION_BATCH_PAUSE", 0.05))
+RETENTION_VACUUM_PAGES = int(os.getenv("ACTIONS_RETENTION_VACUUM_PAGES", 2000))
+
+
+async def run_retention(manager) -> int:
+    """Один проход: свернуть и удалить старые действия пачками, затем incremental vacuum."""
+    total = 0
+    while True:
+        deleted = await manager.rollup_old_actions(RETENTION_DAYS, RETENTION_BATCH_SIZE)
+        total += deleted
+        if deleted < RETENTION_BATCH_SIZE:
+            break
+        # Пауза между пачками, чтобы хендлеры успевали писать
+        await asyncio.sleep(RETENTION_BATCH_PAUSE)
+
+    if total:
+        logger.info(f"🧹 Свернуто и удалено {total} действий старше {RETENTION_DAYS} дн.")
+        if not await manager.incremental_vacuum(RETENTION_VACUUM_PAGES):
+            logger.warning("⚠️ auto_vacuum не INCREMENTAL — выполните разово: python -m core.db_manager vacuum")
+    return total
+
+
+async def retention_loop(manager):
+    """Фоновая задача: периодически применяет политику хранения."""
+    if RETENTION_DAYS <= 0:
+        logger.info("🧹 Политика хранения user_actions отключена")
+        return
+
+    while True:
+        try:
+            await run_retention(manager)
+        except Exception as e:
+            logger.error(f"❌ Ошибка политики хранения: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
@@ -0,0 +1,166 @@
+# core/telegram_sender.py
+"""Исходящие запросы к Bot API с учётом флуд-лимитов Telegram (middleware сессии бота)."""
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, EditMessageText
+
+from core.metrics import TELEGRAM_SEND_WAIT, TELEGRAM_RETRY_AFTER, TELEGRAM_EDITS_COALESCED
+from core.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений/с на бота, ~1/с в личный чат, ~20/мин в группу
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", 3))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", 20 / 60))
+TELEGRAM_CHAT_BUCKETS = int(os.getenv("TELEGRAM_CHAT_BUCKETS", 10000))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 2))
+
+# Приоритеты в общей очереди: ответ на нажатие кнопки — первым (у Telegram на него ~15 с)
+PRIORITY_CALLBACK = 0
+PRIORITY_MESSAGE = 1
+
+
+class TelegramSender(BaseRequestMiddleware):
+    """Общий и по-чатовые token bucket, приоритет callback.answer, склейка edit_text, retry_after.
+
+    Ограничиваются только методы с chat_id и AnswerCallbackQuery; служебные вызовы
+    (getMe, setWebhook и т. п.) проходят без ожидания.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chats = OrderedDict()  # chat_id -> TokenBucket
+        self._blocked_until = {}  # chat_id (None — весь бот) -> monotonic-время окончания retry_after
+        self._waiters = []  # куча (приоритет, порядковый номер, future)
+        self._sequence = itertools.count()
+        self._pump = None
+        self._pending_edits = {}  # (chat_id, message_id, inline_message_id) -> [method, future]
+
+        # Метрики
+        self.coalesced_edits = 0
+        self.retry_after_count = 0
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, AnswerCallbackQuery):
+            return await self._send(make_request, bot, method, None, PRIORITY_CALLBACK)
+        if isinstance(method, EditMessageText):
+            return await self._send_edit(make_request, bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        return await self._send(make_request, bot, method, chat_id, PRIORITY_MESSAGE)
+
+    # === ОЖИДАНИЕ ЛИМИТОВ ===
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(TELEGRAM_GROUP_RATE, 1)
+            else:
+                bucket = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > TELEGRAM_CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_blocked(self, chat_id):
+        """Ждёт окончания retry_after, выданного боту целиком или этому чату."""
+        while True:
+            until = max(self._blocked_until.get(None, 0.0), self._blocked_until.get(chat_id, 0.0))
+            delay = until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _acquire_global(self, priority: int):
+        """Токен общего ведра; при очереди — строго по приоритету, затем по порядку."""
+        if not self._waiters and not self._global.try_acquire():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._pump_waiters())
+        await future
+
+    async def _pump_waiters(self):
+        while self._waiters:
+            await self._global.acquire()
+            while self._waiters:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    async def _acquire(self, chat_id, priority: int, method_name: str):
+        started = time.perf_counter()
+        await self._wait_blocked(chat_id)
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire()
+        await self._acquire_global(priority)
+        TELEGRAM_SEND_WAIT.observe(time.perf_counter() - started, method=method_name)
+
+    # === ОТПРАВКА ===
+    async def _send(self, make_request, bot, method, chat_id, priority: int):
+        await self._acquire(chat_id, priority, type(method).__name__)
+        return await self._request(make_request, bot, method, chat_id, priority)
+
+    async def _request(self, make_request, bot, method, chat_id, priority: int):
+        """Запрос с уже полученным токеном; на TelegramRetryAfter — пауза чата и повтор."""
+        method_name = type(method).__name__
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after_count += 1
+                TELEGRAM_RETRY_AFTER.inc(method=method_name)
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                self._blocked_until[chat_id] = time.monotonic() + e.retry_after
+                logger.warning(f"⏳ Флуд-лимит Telegram ({method_name}, chat={chat_id}): пауза {e.retry_after} с")
+                await self._acquire(chat_id, priority, method_name)
+
+    async def _send_edit(self, make_request, bot, method: EditMessageText):
+        """Правки одного сообщения, ждущие лимита, склеиваются: уходит только последняя."""
+        key = (method.chat_id, method.message_id, method.inline_message_id)
+        pending = self._pending_edits.get(key)
+        if pending is not None:
+            pending[0] = method
+            self.coalesced_edits += 1
+            TELEGRAM_EDITS_COALESCED.inc()
+            return await asyncio.shield(pending[1])
+
+        future = asyncio.get_running_loop().create_future()
+        # Исключение получают ожидающие; если их нет, не пишем «exception was never retrieved»
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        entry = self._pending_edits[key] = [method, future]
+        try:
+            await self._acquire(method.chat_id, PRIORITY_MESSAGE, "EditMessageText")
+        except BaseException:
+            self._pending_edits.pop(key, None)
+            future.cancel()
+            raise
+        # Правки, пришедшие после этого момента, уйдут следующим запросом
+        self._pending_edits.pop(key, None)
+
+        try:
+            result = await self._request(make_request, bot, entry[0], method.chat_id, PRIORITY_MESSAGE)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
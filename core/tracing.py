@@ -0,0 +1,146 @@
+# core/tracing.py
+"""Трассировка апдейтов: время от приёма вебхука до конца хендлера с разбивкой по спанам."""
+import os
+import json
+import time
+import logging
+import functools
+import inspect
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Апдейты дольше порога пишутся в slow-лог с разбивкой по спанам
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", 1.0))
+SLOW_LOG_FILE = os.getenv("SLOW_LOG_FILE", "slow_updates.log")
+SLOW_LOG_MAX_BYTES = int(os.getenv("SLOW_LOG_MAX_BYTES", 5 * 1024 * 1024))
+SLOW_LOG_BACKUPS = int(os.getenv("SLOW_LOG_BACKUPS", 3))
+
+# Момент приёма HTTP-запроса вебхуком (ставит aiohttp-middleware, задача обработки его наследует)
+webhook_received_at: ContextVar[Optional[float]] = ContextVar("webhook_received_at", default=None)
+_current_trace: ContextVar[Optional["UpdateTrace"]] = ContextVar("update_trace", default=None)
+
+slow_logger = logging.getLogger("slow_updates")
+slow_logger.propagate = False
+
+
+class UpdateTrace:
+    """Спаны одного апдейта: суммарное время и число вызовов по имени."""
+
+    __slots__ = ("update_id", "event_type", "started", "received_at", "spans", "_active")
+
+    def __init__(self, update_id: int, event_type: str, received_at: Optional[float] = None):
+        self.update_id = update_id
+        self.event_type = event_type
+        self.started = time.perf_counter()
+        self.received_at = received_at
+        self.spans = {}
+        self._active = set()
+
+    def add(self, name: str, duration: float):
+        span = self.spans.setdefault(name, [0.0, 0])
+        span[0] += duration
+        span[1] += 1
+
+    def to_dict(self, finished: float, **extra) -> dict:
+        origin = self.received_at if self.received_at is not None else self.started
+        return {
+            "update_id": self.update_id,
+            "event_type": self.event_type,
+            **extra,
+            "total_ms": round((finished - origin) * 1000, 1),
+            "queued_ms": round((self.started - origin) * 1000, 1),
+            "spans": {
+                name: {"ms": round(total * 1000, 1), "count": count}
+                for name, (total, count) in sorted(self.spans.items(), key=lambda item: -item[1][0])
+            }
+        }
+
+
+def start_trace(update_id: int, event_type: str):
+    """Начинает трассировку апдейта в текущем контексте; возвращает токен для finish_trace."""
+    trace = UpdateTrace(update_id, event_type, webhook_received_at.get())
+    return trace, _current_trace.set(trace)
+
+
+def finish_trace(trace: UpdateTrace, token, **extra) -> float:
+    """Завершает трассировку, при превышении порога пишет её в slow-лог; возвращает общее время."""
+    _current_trace.reset(token)
+    finished = time.perf_counter()
+    origin = trace.received_at if trace.received_at is not None else trace.started
+    total = finished - origin
+    if total >= SLOW_UPDATE_THRESHOLD:
+        _write_slow(trace.to_dict(finished, **extra))
+    return total
+
+
+def _write_slow(record: dict):
+    # Файл открывается при первом медленном апдейте, а не при импорте
+    if not slow_logger.handlers:
+        handler = RotatingFileHandler(
+            SLOW_LOG_FILE, maxBytes=SLOW_LOG_MAX_BYTES, backupCount=SLOW_LOG_BACKUPS, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_logger.addHandler(handler)
+        slow_logger.setLevel(logging.INFO)
+    slow_logger.info(json.dumps(record, ensure_ascii=False))
+    logger.warning(f"🐢 Медленный апдейт {record['update_id']}: {record['total_ms']} мс")
+
+
+@contextmanager
+def span(name: str):
+    """Засекает время блока в трассировке текущего апдейта (вне апдейта — ничего не делает).
+
+    Вложенные спаны с тем же именем не считаются повторно.
+    """
+    trace = _current_trace.get()
+    if trace is None or name in trace._active:
+        yield
+        return
+    trace._active.add(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace._active.discard(name)
+        trace.add(name, time.perf_counter() - started)
+
+
+def traced(name: str):
+    """Декоратор: оборачивает вызов функции (обычной или корутины) в span(name)."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def http_trace_config():
+    """TraceConfig для aiohttp: исходящие запросы попадают в спан http (до получения заголовков)."""
+    import aiohttp
+
+    async def on_request_start(session, ctx, params):
+        ctx.started = time.perf_counter()
+
+    async def on_request_end(session, ctx, params):
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add("http", time.perf_counter() - ctx.started)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_end)
+    return trace_config
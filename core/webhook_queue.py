@@ -0,0 +1,166 @@
+# core/webhook_queue.py
+"""Быстрый приём вебхука: ответ Telegram сразу, обработка — задачами из ограниченной внутренней очереди."""
+import os
+import hmac
+import time
+import asyncio
+import logging
+from collections import deque
+
+from aiohttp import web
+from aiogram.types import Update
+
+from core.metrics import WEBHOOK_UPDATES, WEBHOOK_QUEUE_WAIT
+from core.middlewares import chat_key
+from core.tracing import webhook_received_at
+
+logger = logging.getLogger(__name__)
+
+# Режим приёма: queue — быстрый ответ и очередь, direct — SimpleRequestHandler aiogram
+WEBHOOK_INGESTION = os.getenv("WEBHOOK_INGESTION", "queue")
+# Сколько чатов обрабатывается одновременно (апдейты одного чата — строго по очереди)
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 256))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+# Сколько ждать места в заполненной очереди, прежде чем ответить 503 (Telegram повторит доставку)
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", 1.0))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", 25))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookQueue:
+    """Ограниченная очередь апдейтов: отвечает Telegram сразу и даёт обратное давление (503).
+
+    Апдейты одного чата ждут в своей очереди и обрабатываются по одному; слот
+    WEBHOOK_CONCURRENCY занимает только обрабатываемый апдейт чата, поэтому
+    чат с длинной очередью не задерживает остальные.
+    """
+
+    def __init__(self, dispatcher, bot, concurrency: int = WEBHOOK_CONCURRENCY, maxsize: int = WEBHOOK_QUEUE_SIZE):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self._incoming = asyncio.Queue()
+        self._capacity = asyncio.Semaphore(maxsize)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._concurrency = concurrency
+        self._chats = {}  # chat_key -> deque апдейтов, ждущих за обрабатываемым
+        self._pending = 0  # принято и ещё не обработано
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._pump = None
+        self._tasks = set()
+        self._accepting = False
+
+    @property
+    def depth(self) -> int:
+        """Апдейты, ждущие обработки."""
+        return self._pending - self.in_flight
+
+    @property
+    def in_flight(self) -> int:
+        """Чаты, чей апдейт обрабатывается сейчас."""
+        return len(self._tasks)
+
+    def start(self):
+        """Запускает разбор очереди (вызывается из on_startup)."""
+        if self._pump is not None:
+            return
+        self._accepting = True
+        self._pump = asyncio.create_task(self._dispatch(), name="webhook-dispatch")
+        logger.info(f"🔄 Очередь вебхука запущена: до {self._concurrency} апдейтов одновременно")
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Перестаёт принимать апдейты, дожидается обработки очереди и останавливает разбор."""
+        self._accepting = False
+        pending = self._pending
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+            logger.info(f"✅ Очередь вебхука обработана ({pending} апдейтов при остановке)")
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"⚠️ Очередь вебхука не обработана за {timeout} с, осталось {self.depth}, в работе {self.in_flight}"
+            )
+        if self._pump is not None:
+            self._pump.cancel()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, *filter(None, [self._pump]), return_exceptions=True)
+        self._pump = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """POST /webhook: проверка секрета, постановка в очередь и немедленный ответ."""
+        secret = os.environ.get("WEBHOOK_SECRET")
+        if not secret or not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            WEBHOOK_UPDATES.inc(result="unauthorized")
+            return web.Response(status=401)
+        if not self._accepting:
+            WEBHOOK_UPDATES.inc(result="rejected")
+            return web.Response(status=503)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            # Повторная доставка не поможет — подтверждаем, чтобы Telegram не слал апдейт снова
+            WEBHOOK_UPDATES.inc(result="invalid")
+            logger.error(f"❌ Некорректный апдейт вебхука: {e}")
+            return web.Response()
+
+        received_at = webhook_received_at.get() or time.perf_counter()
+        try:
+            await asyncio.wait_for(self._capacity.acquire(), WEBHOOK_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            WEBHOOK_UPDATES.inc(result="rejected")
+            logger.warning(f"⚠️ Очередь вебхука переполнена, апдейт {update.update_id} отклонён")
+            return web.Response(status=503)
+
+        self._pending += 1
+        self._drained.clear()
+        self._incoming.put_nowait((update, received_at))
+        WEBHOOK_UPDATES.inc(result="accepted")
+        return web.Response()
+
+    async def _dispatch(self):
+        """Раскладывает апдейты по чатам; для свободного чата ждёт слот и запускает обработку."""
+        while True:
+            update, received_at = await self._incoming.get()
+            key = chat_key(update)
+            waiting = self._chats.get(key)
+            if waiting is not None:
+                # Чат уже в работе: апдейт дождётся своей очереди, слот не занимает
+                waiting.append((update, received_at))
+                continue
+            self._chats[key] = deque()
+            await self._slots.acquire()
+            task = asyncio.create_task(self._run_chat(key, update, received_at))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_chat(self, key, update: Update, received_at: float):
+        """Обрабатывает апдейты чата по порядку, пока они есть, затем освобождает слот."""
+        try:
+            while True:
+                await self._process(update, received_at)
+                waiting = self._chats[key]
+                if not waiting:
+                    del self._chats[key]
+                    return
+                update, received_at = waiting.popleft()
+        finally:
+            self._slots.release()
+
+    async def _process(self, update: Update, received_at: float):
+        try:
+            WEBHOOK_QUEUE_WAIT.observe(time.perf_counter() - received_at)
+            webhook_received_at.set(received_at)
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            self._capacity.release()
+            self._pending -= 1
+            if not self._pending:
+                self._drained.set()
+
+    def register(self, app: web.Application, path: str):
+        app.router.add_post(path, self.handle)
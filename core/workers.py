@@ -0,0 +1,146 @@
+# core/workers.py
+"""Режим нескольких процессов: супервизор запускает WEB_WORKERS воркеров на одном порту (SO_REUSEPORT)."""
+import os
+import sys
+import time
+import signal
+import secrets
+import asyncio
+import logging
+import tempfile
+import subprocess
+
+from core.metrics import REGISTRY, merge_expositions
+
+logger = logging.getLogger(__name__)
+
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))
+# Номер воркера задаёт супервизор; без него процесс работает один (или сам является супервизором)
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if os.getenv("WORKER_INDEX") else None
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", 2))
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv("WORKER_SHUTDOWN_TIMEOUT", 30))
+
+# Каталог, куда воркеры сбрасывают свои метрики для общего /metrics
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", 5))
+# Файлы метрик остановившихся воркеров перестают учитываться через это время
+METRICS_STALE_AFTER = float(os.getenv("METRICS_STALE_AFTER", 60))
+
+
+def is_supervisor() -> bool:
+    return WEB_WORKERS > 1 and WORKER_INDEX is None
+
+
+def is_primary() -> bool:
+    """Основной процесс: ставит вебхук и ведёт фоновые задачи (один процесс или воркер 0)."""
+    return WORKER_INDEX in (None, 0)
+
+
+def worker_env(index: int, base: dict) -> dict:
+    """Окружение воркера: свой номер, общий секрет вебхука, свои файлы спула и slow-лога.
+
+    Кэши FSM и режимов по умолчанию отключены, а FSM пишется сразу (write-through):
+    апдейты одного чата могут прийти в разные воркеры, и состояние должно читаться
+    из общей SQLite уже закоммиченным.
+    """
+    env = dict(base)
+    env["WORKER_INDEX"] = str(index)
+    env["WEB_WORKERS"] = str(WEB_WORKERS)
+    env.setdefault("FSM_CACHE_TTL", "0")
+    env.setdefault("FSM_FLUSH_INTERVAL", "0")
+    env.setdefault("MODE_CACHE_SIZE", "0")
+    if index > 0:
+        # Воркер 0 использует пути по умолчанию и дописывает спул прошлых запусков
+        env.setdefault("ANALYTICS_SPOOL_PATH", f"analytics_spool.worker{index}.db")
+        env.setdefault("SLOW_LOG_FILE", f"slow_updates.worker{index}.log")
+    return env
+
+
+def run_supervisor(script: str) -> int:
+    """Запускает воркеров, перезапускает упавших и останавливает всех по SIGTERM/SIGINT."""
+    base = dict(os.environ)
+    # Секрет вебхука общий: его ставит воркер 0, а проверяют все
+    base.setdefault("WEBHOOK_SECRET", secrets.token_urlsafe(32))
+    base.setdefault("METRICS_DIR", tempfile.mkdtemp(prefix="bot-metrics-"))
+
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    def spawn(index: int) -> subprocess.Popen:
+        process = subprocess.Popen([sys.executable, script], env=worker_env(index, base))
+        logger.info(f"🚀 Воркер {index} запущен (pid={process.pid})")
+        return process
+
+    workers = [spawn(index) for index in range(WEB_WORKERS)]
+    logger.info(f"✅ Супервизор запущен, воркеров: {WEB_WORKERS}, метрики в {base['METRICS_DIR']}")
+
+    while not stopping:
+        time.sleep(0.5)
+        for index, process in enumerate(workers):
+            if process.poll() is not None and not stopping:
+                logger.error(f"❌ Воркер {index} завершился с кодом {process.returncode}, перезапуск")
+                time.sleep(WORKER_RESTART_DELAY)
+                workers[index] = spawn(index)
+
+    logger.info("Останавливаю воркеров...")
+    for process in workers:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+    for index, process in enumerate(workers):
+        try:
+            process.wait(timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            logger.warning(f"⚠️ Воркер {index} не остановился за {WORKER_SHUTDOWN_TIMEOUT} с, kill")
+            process.kill()
+            process.wait()
+    logger.info("Супервизор остановлен")
+    return 0
+
+
+# === МЕТРИКИ ВОРКЕРОВ ===
+def dump_metrics():
+    """Атомарно записывает метрики этого воркера в METRICS_DIR."""
+    path = os.path.join(METRICS_DIR, f"worker-{WORKER_INDEX}.prom")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp_path, path)
+
+
+async def metrics_dump_loop():
+    """Периодически сбрасывает метрики воркера на диск."""
+    while True:
+        try:
+            await asyncio.to_thread(dump_metrics)
+        except Exception as e:
+            logger.error(f"❌ Не удалось сохранить метрики воркера: {e}")
+        await asyncio.sleep(METRICS_DUMP_INTERVAL)
+
+
+def render_metrics() -> str:
+    """Метрики процесса, а в режиме воркеров — всех воркеров с меткой worker."""
+    if WORKER_INDEX is None or not METRICS_DIR:
+        return REGISTRY.render()
+
+    dump_metrics()
+    texts = {}
+    now = time.time()
+    for name in sorted(os.listdir(METRICS_DIR)):
+        if not (name.startswith("worker-") and name.endswith(".prom")):
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > METRICS_STALE_AFTER:
+                continue
+            with open(path, encoding="utf-8") as f:
+                texts[name[len("worker-"):-len(".prom")]] = f.read()
+        except OSError:
+            continue
+    return merge_expositions(texts, "worker")
@@ -1,25 +1,51 @@
 import os
 import asyncio
-import aiohttp
 import secrets
 import logging
-from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.filters import Command, CommandStart
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler
-from aiohttp import web
+from core.profiling import startup_profiler
+
+with startup_profiler.phase("import aiohttp"):
+    import aiohttp
+    from aiohttp import web
+with startup_profiler.phase("import aiogram"):
+    from aiogram import Bot, Dispatcher, F
+    from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+    from aiogram.filters import Command, CommandStart
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-from core.analytics import analytics
+with startup_profiler.phase("import analytics"):
+    from core.analytics import analytics
+from core.http_client import http_client
+with startup_profiler.phase("DatabaseManager.init_database"):
+    from core.db_manager import db_manager
+with startup_profiler.phase("Database.load_data"):
+    from core.database import db
+from core.fsm_storage import SQLiteStorage, KeyedEventIsolation
+from core.mode_service import mode_service
+from core.generation_cache import generation_cache
+from core.metrics import Gauge
+from core.dedup import update_deduplicator
+from core.telegram_sender import TelegramSender
+from core.workers import (
+    WEB_WORKERS, WORKER_INDEX, METRICS_DIR, is_supervisor, is_primary, run_supervisor, metrics_dump_loop, render_metrics
+)
+from core.webhook_queue import WebhookQueue, WEBHOOK_INGESTION
+from core.health import health_prober, probe_webhook, probe_sqlite, probe_sheets, probe_analytics_queue
+from core.middlewares import (
+    UpdateMetricsMiddleware, HandlerMetricsMiddleware, TracingMiddleware, TelegramTracingMiddleware,
+    ChatLaneMiddleware, DedupMiddleware,
+    http_metrics_middleware, webhook_receipt_middleware
+)
 
 # Инициализация
-bot = Bot(token=os.getenv("BOT_TOKEN"))
-dp = Dispatcher()
-
-# === ХРАНЕНИЕ ТЕКУЩЕГО РЕЖИМА ДЛЯ КАЖДОГО ПОЛЬЗОВАТЕЛЯ ===
-user_modes = {}  # {user_id: "subscription"/"info"/"content"}
+with startup_profiler.phase("init bot/dispatcher"):
+    bot = Bot(token=os.getenv("BOT_TOKEN"))
+    # Изоляция событий: FSM-состояние читается уже под замком чата/пользователя,
+    # иначе апдейт, пришедший следом, видит состояние до завершения предыдущего
+    dp = Dispatcher(storage=SQLiteStorage(), events_isolation=KeyedEventIsolation())
 
 
 # === КЛАВИАТУРА ДЛЯ ВЫБОРА РЕЖИМА ===
@@ -49,9 +75,6 @@ async def cmd_start(message: Message):
         details="Пользователь начал работу"
     )
 
-    if user_id not in user_modes:
-        user_modes[user_id] = "subscription"
-
     await message.answer(
         "🚀 **Портфолио Telegram-ботов**\n\n"
         "Выберите демо-бот для тестирования:\n\n"
@@ -77,7 +100,7 @@ async def cmd_mode(message: Message):
 async def cmd_help(message: Message):
     """Помощь"""
     user_id = message.from_user.id
-    current_mode = user_modes.get(user_id, "subscription")
+    current_mode = await mode_service.get_mode(user_id)
     mode_names = {
         "subscription": "Бот подписок",
         "info": "Инфо-бот с партнёрками",
@@ -106,11 +129,9 @@ async def mode_handler(callback: CallbackQuery):
     mode = callback.data.replace("mode_", "")
 
     try:
-        from core.db_manager import db_manager
-        db_manager.set_user_mode(user_id, username, mode)
+        await mode_service.set_mode(user_id, username, mode)
     except Exception as e:
-        logger.warning(f"Не удалось сохранить в БД, используем user_modes: {e}")
-        user_modes[user_id] = mode
+        logger.warning(f"Не удалось сохранить режим в БД, он остаётся только в кэше: {e}")
 
     mode_names = {
         "subscription": "🤖 Бот подписок",
@@ -147,7 +168,7 @@ async def mode_handler(callback: CallbackQuery):
     await callback.message.delete()
 
 
-# === SELF-PING (использует внешнюю сессию, без утечек) ===
+# === SELF-PING (использует общую сессию приложения, без утечек) ===
 async def self_ping(session: aiohttp.ClientSession):
     """Держит контейнер активным — пинг ВСЕХ важных эндпоинтов"""
     urls = [
@@ -158,8 +179,8 @@ async def self_ping(session: aiohttp.ClientSession):
     while True:
         for url in urls:
             try:
-                await session.get(url, timeout=5)
-                logger.debug(f"Self-ping: {url}")
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)):
+                    logger.debug(f"Self-ping: {url}")
             except Exception as e:
                 logger.error(f"Self-ping error for {url}: {e}")
         await asyncio.sleep(240)  # 4 минуты
@@ -183,13 +204,64 @@ async def webhook_watchdog(bot: Bot):
 
 
 # === ПОДКЛЮЧЕНИЕ ВСЕХ РОУТЕРОВ ОДИН РАЗ ===
-from bots.subscription_bot import router as subscription_router
-from bots.info_bot import router as info_router
-from bots.content_bot import router as content_router
-
-dp.include_router(subscription_router)
-dp.include_router(info_router)
-dp.include_router(content_router)
+with startup_profiler.phase("router registration"):
+    from bots.subscription_bot import router as subscription_router
+    from bots.info_bot import router as info_router
+    from bots.content_bot import router as content_router
+
+    dp.include_router(subscription_router)
+    dp.include_router(info_router)
+    dp.include_router(content_router)
+
+
+# Очередь приёма вебхука (WEBHOOK_INGESTION=queue)
+webhook_queue = WebhookQueue(dp, bot)
+
+
+# === МЕТРИКИ И ТРАССИРОВКА ===
+# Дедупликация — первой, чтобы повторы не доходили ни до метрик, ни до хендлеров
+# В режиме воркеров повтор может прийти в другой процесс — окно проверяется в общей SQLite
+dp.update.outer_middleware(DedupMiddleware(update_deduplicator, db_manager if WORKER_INDEX is not None else None))
+dp.update.outer_middleware(TracingMiddleware())
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+# Последовательная обработка апдейтов в пределах чата (Database и группы без гонок);
+# порядок чтения FSM-состояния обеспечивает KeyedEventIsolation, разные чаты идут параллельно
+chat_lanes = ChatLaneMiddleware()
+dp.update.outer_middleware(chat_lanes)
+bot.session.middleware(TelegramTracingMiddleware())
+# Флуд-лимиты Telegram: общий и по-чатовые лимиты, приоритет callback.answer, склейка правок
+telegram_sender = TelegramSender()
+bot.session.middleware(telegram_sender)
+handler_metrics = HandlerMetricsMiddleware({
+    dp: "dispatcher",
+    subscription_router: "subscription",
+    info_router: "info",
+    content_router: "content"
+})
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+
+Gauge("sheets_queue_depth", "События в очереди на запись в Google Sheets", lambda: analytics.queue_depth)
+Gauge("sheets_spooled_events", "События в локальном спуле аналитики", lambda: analytics.spooled_events)
+Gauge("webhook_queue_depth", "Апдейты во внутренней очереди вебхука", lambda: webhook_queue.depth)
+Gauge("webhook_updates_in_flight", "Чаты, чей апдейт из очереди вебхука сейчас в обработке", lambda: webhook_queue.in_flight)
+Gauge("chat_lanes_active", "Чаты с апдейтами в работе или в ожидании", lambda: chat_lanes.active_lanes)
+Gauge("generation_cache_hits", "Попадания в кэш генерации по уровням", lambda: {
+    "memory": generation_cache.hits,
+    "sqlite": generation_cache.persistent_hits
+}, ("tier",))
+Gauge("generation_cache_misses", "Промахи кэша генерации", lambda: generation_cache.misses)
+Gauge("generation_cache_entries", "Записи в памяти кэша генерации", lambda: generation_cache.get_stats()["entries"])
+Gauge("mode_cache_hits", "Попадания в кэш режимов пользователей", lambda: mode_service.hits)
+Gauge("mode_cache_misses", "Промахи кэша режимов пользователей", lambda: mode_service.misses)
+Gauge("mode_cache_entries", "Записи в кэше режимов пользователей", lambda: mode_service.get_stats()["entries"])
+Gauge("fsm_states", "Пользователи по FSM-состояниям", lambda: dp.storage.get_state_counts(), ("state",))
+
+# Readiness: вебхук и SQLite критичны, Sheets и очередь аналитики — нет (события уходят в спул)
+health_prober.add_check("webhook", lambda: probe_webhook(bot))
+health_prober.add_check("sqlite", lambda: probe_sqlite(db_manager))
+health_prober.add_check("sheets", lambda: probe_sheets(analytics), critical=False)
+health_prober.add_check("analytics_queue", lambda: probe_analytics_queue(analytics), critical=False)
 
 
 # === ВЕБХУКИ И HEALTH CHECK ===
@@ -198,24 +270,35 @@ async def health_check(request):
     return web.Response(text="✅ Портфолио ботов работает")
 
 
-async def on_startup(app):
-    """Действия при запуске"""
-    # 1. Генерируем секретный токен
-    secret_token = secrets.token_urlsafe(32)
-    os.environ["WEBHOOK_SECRET"] = secret_token
+async def metrics_handler(request):
+    """Метрики в формате Prometheus"""
+    return web.Response(
+        body=render_metrics().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
 
-    # 2. Удаляем старый вебхук
-    await bot.delete_webhook(drop_pending_updates=True)
-    logger.info("✅ Старый вебхук удалён, апдейты сброшены")
 
-    # 3. Устанавливаем новый с секретным токеном
-    webhook_url = f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}/webhook"
-    await bot.set_webhook(
-        url=webhook_url,
-        secret_token=secret_token,
-        drop_pending_updates=True,
-        max_connections=40
-    )
+async def setup_webhook(secret_token: str):
+    """Переустанавливает вебхук с секретным токеном и выводит диагностику"""
+    with startup_profiler.phase("webhook setup"):
+        webhook_url = f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}/webhook"
+        # 2. Удаляем старый вебхук. Если он уже наш (перезапуск воркера 0), апдейты в очереди
+        # Telegram не сбрасываем: их ещё обработают остальные воркеры
+        current = await bot.get_webhook_info()
+        drop_pending = current.url != webhook_url
+        if drop_pending:
+            await bot.delete_webhook(drop_pending_updates=True)
+            logger.info("✅ Старый вебхук удалён, апдейты сброшены")
+        else:
+            logger.info(f"♻️ Вебхук уже установлен, ожидающих апдейтов: {current.pending_update_count}")
+
+        # 3. Устанавливаем вебхук с секретным токеном (токен мог смениться)
+        await bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            drop_pending_updates=drop_pending,
+            max_connections=40
+        )
     logger.info(f"✅ Webhook установлен: {webhook_url}")
     logger.info(f"🔐 Secret token: {secret_token[:10]}... (усечён)")
 
@@ -227,6 +310,27 @@ async def on_startup(app):
     logger.info(f"❌ Last error message: {webhook_info.last_error_message}")
     logger.info(f"🔗 Max connections: {webhook_info.max_connections}")
 
+
+async def on_startup(app):
+    """Действия при запуске"""
+    # 0. Подключение к Google Sheets — в фоне, не задерживая старт (события копятся в очереди)
+    await analytics.start()
+    # Окно обработанных update_id — до приёма апдейтов
+    await update_deduplicator.load(db_manager)
+    # Воркеры очереди вебхука — до установки вебхука, чтобы сразу принимать апдейты
+    if WEBHOOK_INGESTION == "queue":
+        webhook_queue.start()
+
+    # 1. Секретный токен: в режиме воркеров общий, его передаёт супервизор
+    secret_token = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+    os.environ["WEBHOOK_SECRET"] = secret_token
+
+    # 2-4. Вебхук ставит только основной процесс (воркер 0)
+    if is_primary():
+        await setup_webhook(secret_token)
+    else:
+        logger.info(f"👷 Воркер {WORKER_INDEX}: вебхук и фоновые задачи ведёт воркер 0")
+
     # 5. Проверка Google Credentials
     b64 = os.getenv("GOOGLE_CREDENTIALS_BASE64")
     if b64:
@@ -236,42 +340,87 @@ async def on_startup(app):
     else:
         logger.error("❌ GOOGLE_CREDENTIALS_BASE64 НЕ НАЙДЕНА!")
 
-    # 6. Создаём клиентскую сессию для self-ping (будет жить всё время приложения)
-    app['client_session'] = aiohttp.ClientSession()
+    # 6. Создаём общую HTTP-сессию (OpenAI, self-ping) на всё время приложения
+    await http_client.start()
+
+    if is_primary():
+        # 7. Запускаем self-ping с этой сессией
+        asyncio.create_task(self_ping(http_client.session))
+        logger.info("🔄 Self-ping запущен")
+
+        # 8. Запускаем watchdog вебхука
+        asyncio.create_task(webhook_watchdog(bot))
+        logger.info("🔄 Webhook watchdog запущен")
+
+        # 9. Запускаем политику хранения user_actions
+        from core.retention import retention_loop
+        asyncio.create_task(retention_loop(db_manager))
+        logger.info("🔄 Политика хранения user_actions запущена")
+
+        # 10. Чистка просроченных записей постоянного кэша генерации
+        if generation_cache.persistent:
+            asyncio.create_task(generation_cache.purge_loop())
+            logger.info("🔄 Чистка кэша генерации запущена")
 
-    # 7. Запускаем self-ping с этой сессией
-    asyncio.create_task(self_ping(app['client_session']))
-    logger.info("🔄 Self-ping запущен")
+    # 11. Запускаем фоновые health-проверки для /health/ready
+    health_prober.start()
+    logger.info("🔄 Health-пробер запущен")
 
-    # 8. Запускаем watchdog вебхука
-    asyncio.create_task(webhook_watchdog(bot))
-    logger.info("🔄 Webhook watchdog запущен")
+    # 12. В режиме воркеров сбрасываем метрики в общий каталог для /metrics
+    if WORKER_INDEX is not None and METRICS_DIR:
+        asyncio.create_task(metrics_dump_loop())
+
+    # 13. Отчёт о времени холодного старта (STARTUP_PROFILE=1)
+    startup_profiler.log_report()
 
 
 async def on_shutdown(app):
     """Действия при остановке"""
-    await bot.delete_webhook()
-    logger.info("Вебхук удалён при остановке")
+    if is_primary():
+        await bot.delete_webhook()
+        logger.info("Вебхук удалён при остановке")
+
+    await health_prober.stop()
+
+    # Дорабатываем принятые апдейты
+    if WEBHOOK_INGESTION == "queue":
+        await webhook_queue.stop()
+
+    # Дописываем накопленные события аналитики
+    await analytics.stop()
 
-    # Закрываем сессию aiohttp
-    if 'client_session' in app:
-        await app['client_session'].close()
-        logger.info("✅ Клиентская сессия закрыта")
+    # Сохраняем окно update_id, FSM-состояния и закрываем соединения с SQLite
+    await update_deduplicator.save(db_manager)
+    await dp.storage.close()
+    db_manager.close()
+    db.close()
+
+    # Закрываем общую сессию aiohttp
+    await http_client.close()
 
     logger.info("Бот остановлен")
 
 
 def main():
-    """Запуск сервера"""
-    app = web.Application()
+    """Запуск сервера (или супервизора воркеров при WEB_WORKERS > 1)"""
+    if is_supervisor():
+        raise SystemExit(run_supervisor(os.path.abspath(__file__)))
+
+    app = web.Application(middlewares=[webhook_receipt_middleware, http_metrics_middleware])
 
-    # Health check
+    # Health check и метрики
     app.router.add_get("/", health_check)
     app.router.add_get("/health", health_check)
+    app.router.add_get("/health/live", health_prober.live)
+    app.router.add_get("/health/ready", health_prober.ready)
+    app.router.add_get("/metrics", metrics_handler)
 
     # Вебхук для бота
-    webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
-    webhook_handler.register(app, path="/webhook")
+    if WEBHOOK_INGESTION == "queue":
+        webhook_queue.register(app, path="/webhook")
+    else:
+        webhook_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+        webhook_handler.register(app, path="/webhook")
 
     # События
     app.on_startup.append(on_startup)
@@ -280,7 +429,8 @@ def main():
     # Запуск
     port = int(os.getenv("PORT", 8080))
     logger.info(f"Сервер запущен на порту {port}")
-    web.run_app(app, host="0.0.0.0", port=port)
+    # Воркеры слушают один порт, соединения между ними распределяет ядро (SO_REUSEPORT)
+    web.run_app(app, host="0.0.0.0", port=port, reuse_port=WEB_WORKERS > 1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,8 @@
+# tests/conftest.py
+"""Тесты не трогают рабочие файлы: глобальные экземпляры (db_manager и др.) открывают БД в cwd."""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
@@ -0,0 +1,76 @@
+# tests/test_chat_ordering.py
+"""Порядок апдейтов одного чата: callback, меняющий FSM-состояние, и следующее за ним сообщение."""
+import asyncio
+import datetime
+
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.filters import StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+from core.fsm_storage import SQLiteStorage, KeyedEventIsolation
+from core.middlewares import ChatLaneMiddleware
+
+# Имитация задержки Bot API (callback.answer / edit_text) перед сменой состояния
+API_LATENCY = 0.1
+
+
+class Topic(StatesGroup):
+    waiting = State()
+
+
+def make_dispatcher(db_path, handled: list) -> Dispatcher:
+    """Диспетчер с той же конфигурацией, что в main.py, и хендлерами как в content_bot."""
+    dp = Dispatcher(storage=SQLiteStorage(str(db_path)), events_isolation=KeyedEventIsolation())
+    dp.update.outer_middleware(ChatLaneMiddleware())
+    router = Router()
+
+    @router.callback_query(F.data == "generate_post")
+    async def generate_post(callback: CallbackQuery, state: FSMContext):
+        await asyncio.sleep(API_LATENCY)
+        await state.set_state(Topic.waiting)
+
+    @router.message(StateFilter(Topic.waiting))
+    async def process_topic(message: Message, state: FSMContext):
+        handled.append(message.text)
+        await state.set_state(None)
+
+    dp.include_router(router)
+    return dp
+
+
+def updates(chat_id: int):
+    user = User(id=chat_id, is_bot=False, first_name="Test")
+    chat = Chat(id=chat_id, type="private")
+    now = datetime.datetime.now()
+    callback = Update(update_id=chat_id * 10, callback_query=CallbackQuery(
+        id=str(chat_id), from_user=user, chat_instance="1", data="generate_post",
+        message=Message(message_id=1, date=now, chat=chat, from_user=user, text="menu")
+    ))
+    message = Update(update_id=chat_id * 10 + 1, message=Message(
+        message_id=2, date=now, chat=chat, from_user=user, text=f"topic {chat_id}"
+    ))
+    return callback, message
+
+
+def test_message_after_callback_sees_new_state(tmp_path):
+    handled = []
+
+    async def run():
+        bot = Bot("123456:ABCDEFabcdef")
+        dp = make_dispatcher(tmp_path / "fsm.db", handled)
+        try:
+            tasks = []
+            for chat_id in range(1, 6):
+                # Апдейты приходят почти одновременно, как при фоновой обработке вебхука
+                for update in updates(chat_id):
+                    tasks.append(asyncio.create_task(dp.feed_update(bot, update)))
+            await asyncio.gather(*tasks)
+            assert not dp.fsm.events_isolation._locks
+        finally:
+            await dp.storage.close()
+            await bot.session.close()
+
+    asyncio.run(run())
+    assert sorted(handled) == [f"topic {chat_id}" for chat_id in range(1, 6)]
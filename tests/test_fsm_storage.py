@@ -0,0 +1,67 @@
+# tests/test_fsm_storage.py
+"""SQLiteStorage: изменения, сделанные во время записи на диск, не теряются."""
+import time
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from core import fsm_storage
+from core.fsm_storage import SQLiteStorage
+
+WRITE_LATENCY = 0.05
+
+
+def test_changes_during_inflight_write_are_kept(tmp_path, monkeypatch):
+    # Без кэша по времени: каждое чтение незакреплённой записи идёт на диск
+    monkeypatch.setattr(fsm_storage, "FSM_CACHE_TTL", 0)
+    monkeypatch.setattr(fsm_storage, "FSM_FLUSH_INTERVAL", 0.01)
+
+    async def run():
+        storage = SQLiteStorage(str(tmp_path / "fsm.db"))
+        write = storage._write
+
+        def slow_write(rows):
+            time.sleep(WRITE_LATENCY)
+            write(rows)
+
+        storage._write = slow_write
+        try:
+            for chat_id in range(10):
+                key = StorageKey(bot_id=1, chat_id=chat_id, user_id=chat_id)
+                await storage.set_state(key, "ContentGen:waiting_for_topic")
+                # Первая запись уже идёт в потоке
+                await asyncio.sleep(WRITE_LATENCY / 2)
+                assert await storage.get_state(key) == "ContentGen:waiting_for_topic"
+                await storage.set_data(key, {"topic": f"topic {chat_id}"})
+
+            await asyncio.sleep(WRITE_LATENCY * 4)
+            storage._cache.clear()
+            for chat_id in range(10):
+                key = StorageKey(bot_id=1, chat_id=chat_id, user_id=chat_id)
+                assert await storage.get_state(key) == "ContentGen:waiting_for_topic"
+                assert await storage.get_data(key) == {"topic": f"topic {chat_id}"}
+        finally:
+            await storage.close()
+
+    asyncio.run(run())
+
+
+def test_write_through_is_visible_to_another_worker(tmp_path, monkeypatch):
+    # Настройки воркера из core/workers.py: без кэша и без отложенной записи
+    monkeypatch.setattr(fsm_storage, "FSM_CACHE_TTL", 0)
+    monkeypatch.setattr(fsm_storage, "FSM_FLUSH_INTERVAL", 0)
+
+    async def run():
+        first = SQLiteStorage(str(tmp_path / "fsm.db"))
+        second = SQLiteStorage(str(tmp_path / "fsm.db"))
+        key = StorageKey(bot_id=1, chat_id=1, user_id=1)
+        try:
+            await first.set_state(key, "ContentGen:waiting_for_topic")
+            await first.set_data(key, {"topic": "SQLite"})
+            assert await second.get_state(key) == "ContentGen:waiting_for_topic"
+            assert await second.get_data(key) == {"topic": "SQLite"}
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+# tests/test_openai_stream.py
+"""parse_sse_stream и _request_openai против локального stub-сервера OpenAI."""
+import json
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from bots import content_bot
+from core.http_client import http_client
+
+
+def sse(*payloads) -> bytes:
+    return b"".join(f"data: {payload}\n\n".encode("utf-8") for payload in payloads)
+
+
+def chunk(text: str) -> str:
+    return json.dumps({"choices": [{"delta": {"content": text}}]})
+
+
+async def request_stub(handler, monkeypatch, prompt="тема", on_progress=None):
+    """Поднимает stub /v1/chat/completions и выполняет через него _request_openai."""
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handler)
+    server = TestServer(app)
+    await server.start_server()
+    monkeypatch.setattr(content_bot, "OPENAI_API_URL", str(server.make_url("/v1/chat/completions")))
+    monkeypatch.setattr(content_bot, "OPENAI_API_KEY", "test-key", raising=False)
+    await http_client.start()
+    try:
+        return await content_bot._request_openai(prompt, on_progress)
+    finally:
+        await http_client.close()
+        await server.close()
+
+
+def stream_handler(body: bytes, parts: int = 1):
+    """Отдаёт body SSE-потоком, разрезав на parts кусков (границы не совпадают со строками)."""
+    async def handler(request):
+        data = await request.json()
+        assert data["stream"] is True
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        size = -(-len(body) // parts)
+        for start in range(0, len(body), size):
+            await response.write(body[start:start + size])
+            await asyncio.sleep(0)
+        await response.write_eof()
+        return response
+    return handler
+
+
+def test_stream_reassembles_chunked_response(monkeypatch):
+    body = sse(chunk("Привет"), chunk(", "), json.dumps({"choices": [{"delta": {}}]}), chunk("мир"), "[DONE]")
+    progress = []
+
+    async def on_progress(text):
+        progress.append(text)
+
+    result = asyncio.run(request_stub(stream_handler(body, parts=7), monkeypatch, on_progress=on_progress))
+
+    assert result == "Привет, мир"
+    assert progress == ["Привет", "Привет, ", "Привет, мир"]
+
+
+def test_stream_stops_at_done(monkeypatch):
+    body = sse(chunk("до"), "[DONE]", chunk("после"))
+
+    async def on_progress(text):
+        pass
+
+    assert asyncio.run(request_stub(stream_handler(body), monkeypatch, on_progress=on_progress)) == "до"
+
+
+def test_stream_malformed_payload_raises(monkeypatch):
+    body = sse(chunk("начало"), "{не json")
+
+    async def on_progress(text):
+        pass
+
+    with pytest.raises(json.JSONDecodeError):
+        asyncio.run(request_stub(stream_handler(body), monkeypatch, on_progress=on_progress))
+
+
+def test_rate_limited_response(monkeypatch):
+    async def handler(request):
+        return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "2"})
+
+    with pytest.raises(content_bot.OpenAIRateLimited) as error:
+        asyncio.run(request_stub(handler, monkeypatch))
+    assert error.value.retry_after == 2.0
+
+
+def test_parse_sse_stream_skips_non_data_lines():
+    async def lines():
+        for line in [b": keep-alive\n", b"event: message\n", f"data: {chunk('x')}\n".encode(), b"\n", b"data: [DONE]\n"]:
+            yield line
+
+    async def collect():
+        return [delta async for delta in content_bot.parse_sse_stream(lines())]
+
+    assert asyncio.run(collect()) == ["x"]
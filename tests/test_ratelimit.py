@@ -0,0 +1,59 @@
+# tests/test_ratelimit.py
+"""SingleFlight: общая задача живёт, пока её результат кому-то нужен."""
+import asyncio
+
+from core.ratelimit import SingleFlight
+
+
+def test_shared_call_is_cancelled_with_last_waiter():
+    started, cancelled = [], []
+
+    async def request():
+        started.append(True)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run():
+        flights = SingleFlight()
+        first = asyncio.create_task(flights.do("prompt", request))
+        second = asyncio.create_task(flights.do("prompt", request))
+        await asyncio.sleep(0.01)
+        assert flights.coalesced == 1
+
+        # Один ожидающий ушёл — запрос продолжается для второго
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled
+
+        second.cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled == [True]
+
+        # Следующий вызов с тем же ключом запускает новый запрос, а не получает отменённый
+        async def fresh():
+            return "ok"
+
+        assert await flights.do("prompt", fresh) == "ok"
+        await asyncio.gather(first, second, return_exceptions=True)
+
+    asyncio.run(run())
+    assert started == [True]
+
+
+def test_waiters_share_result():
+    calls = []
+
+    async def request():
+        calls.append(True)
+        await asyncio.sleep(0.01)
+        return "content"
+
+    async def run():
+        flights = SingleFlight()
+        return await asyncio.gather(*(flights.do("prompt", request) for _ in range(3)))
+
+    assert asyncio.run(run()) == ["content"] * 3
+    assert calls == [True]
@@ -0,0 +1,75 @@
+# tests/test_webhook_queue.py
+"""WebhookQueue: порядок внутри чата и независимость чатов друг от друга."""
+import time
+import asyncio
+import datetime
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot
+from aiogram.types import Chat, Message, Update, User
+
+from core.webhook_queue import WebhookQueue, SECRET_HEADER
+
+SECRET = "test-secret"
+SLOW_UPDATE = 0.05
+
+
+class RecordingDispatcher:
+    """Вместо aiogram: медленные апдейты чата 1, мгновенные — остальных."""
+
+    def __init__(self):
+        self.handled = []
+
+    async def feed_update(self, bot, update: Update):
+        if update.message.chat.id == 1:
+            await asyncio.sleep(SLOW_UPDATE)
+        self.handled.append((update.message.chat.id, update.update_id, time.perf_counter()))
+
+
+def message_update(update_id: int, chat_id: int) -> dict:
+    user = User(id=chat_id, is_bot=False, first_name="Test")
+    update = Update(update_id=update_id, message=Message(
+        message_id=update_id, date=datetime.datetime.now(), chat=Chat(id=chat_id, type="private"),
+        from_user=user, text=str(update_id)
+    ))
+    return update.model_dump(mode="json", exclude_none=True)
+
+
+def test_busy_chat_does_not_hold_other_chats(monkeypatch):
+    monkeypatch.setenv("WEBHOOK_SECRET", SECRET)
+    dispatcher = RecordingDispatcher()
+
+    async def run():
+        bot = Bot("123456:ABCDEFabcdef")
+        queue = WebhookQueue(dispatcher, bot, concurrency=2, maxsize=100)
+        app = web.Application()
+        queue.register(app, "/webhook")
+        queue.start()
+        try:
+            async with TestClient(TestServer(app)) as client:
+                # Чат 1 набирает очередь больше числа слотов, затем пишут другие чаты
+                for update_id in range(1, 11):
+                    response = await client.post(
+                        "/webhook", json=message_update(update_id, 1), headers={SECRET_HEADER: SECRET}
+                    )
+                    assert response.status == 200
+                started = time.perf_counter()
+                for update_id in range(11, 21):
+                    response = await client.post(
+                        "/webhook", json=message_update(update_id, update_id), headers={SECRET_HEADER: SECRET}
+                    )
+                    assert response.status == 200
+                await queue.stop()
+        finally:
+            await bot.session.close()
+        return started
+
+    started = asyncio.run(run())
+
+    slow = [update_id for chat_id, update_id, _ in dispatcher.handled if chat_id == 1]
+    assert slow == list(range(1, 11))
+    others = [at - started for chat_id, _, at in dispatcher.handled if chat_id != 1]
+    assert len(others) == 10
+    # Остальные чаты не ждут, пока чат 1 разберёт свои 10 апдейтов
+    assert max(others) < SLOW_UPDATE * 2